@@ -0,0 +1,432 @@
+# Offline benchmark of the repodigger pipeline.
+#
+# Generates a synthetic organization of local bare repositories (with git fast-import), serves
+# a fake GitHub API for them from a local HTTP server and runs the pipeline stages against it:
+# discovery, the optional pre-clone build system check, cloning, build system check, git log
+# export and test commit filtering, and merging. Each stage is timed and reported with its throughput and the
+# peak RSS reached so far, so changes to the hot paths can be measured without network access.
+#
+# Usage:
+#   python benchmarks/bench_pipeline.py --repos 50 --commits 2000 --files 200 --clone-workers 4 --log-workers 4
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# repodigger refuses to import without a token; the stub API does not check it
+os.environ.setdefault('GITHUB_TOKEN', 'offline-benchmark')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import repodigger  # noqa: E402
+
+BENCH_ORG = "bench"
+BUILD_LAYOUTS = {
+    'maven': ["pom.xml"],
+    'gradle': ["build.gradle", "settings.gradle"],
+    'ant': ["build.xml"],
+    'mixed': ["pom.xml", "build.xml"], # Maven and Ant: rejected by the build system check
+    'none': [],
+}
+# Lines per generated source file; every commit rewrites one line of each file it touches
+FILE_LINES = 40
+# Epoch of the first synthetic commit
+FIRST_COMMIT_TIME = 1600000000
+
+
+def source_file_path(index):
+    # About a quarter of the files are tests, which the test commit filter picks up
+    if index % 4 == 3:
+        return f"src/test/java/org/bench/Module{index}Test.java"
+    return f"src/main/java/org/bench/Module{index}.java"
+
+
+def source_file_content(index, revision):
+    lines = [f"// Module {index} line {line}" for line in range(FILE_LINES)]
+    lines[revision % FILE_LINES] = f"// Module {index} revision {revision}"
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+# Build the fast-import stream of a repository: one commit adding every file, then commits that
+# each modify files_per_commit files in round-robin order
+def iter_fast_import_stream(commit_count, file_count, layout, files_per_commit):
+    def blob(path, data):
+        return b"M 100644 inline " + path.encode('utf-8') + b"\ndata " + str(len(data)).encode() + b"\n" + data + b"\n"
+
+    def commit_header(number, message):
+        timestamp = FIRST_COMMIT_TIME + number * 3600
+        author = f"Dev {number % 7} <dev{number % 7}@bench.example> {timestamp} +0000"
+        message = message.encode('utf-8')
+        return (f"commit refs/heads/main\nmark :{number + 1}\nauthor {author}\ncommitter {author}\n".encode('utf-8')
+                + b"data " + str(len(message)).encode() + b"\n" + message + b"\n")
+
+    parts = [commit_header(0, "Initial import")]
+    for build_file in BUILD_LAYOUTS[layout]:
+        parts.append(blob(build_file, f"<!-- {build_file} of a synthetic {layout} project -->\n".encode('utf-8')))
+    for index in range(file_count):
+        parts.append(blob(source_file_path(index), source_file_content(index, 0)))
+    yield b"".join(parts)
+
+    next_file = 0
+    for number in range(1, commit_count):
+        parts = [commit_header(number, f"Change {number}")]
+        for _ in range(min(files_per_commit, file_count)):
+            parts.append(blob(source_file_path(next_file), source_file_content(next_file, number)))
+            next_file = (next_file + 1) % file_count
+        yield b"".join(parts) + b"\n"
+
+
+def create_synthetic_repo(bare_path, commit_count, file_count, layout, files_per_commit):
+    subprocess.run(['git', 'init', '--quiet', '--bare', bare_path], check=True)
+    subprocess.run(['git', '-C', bare_path, 'symbolic-ref', 'HEAD', 'refs/heads/main'], check=True)
+    # Lets --clone-mode blobless/treeless clone from the file:// URL
+    subprocess.run(['git', '-C', bare_path, 'config', 'uploadpack.allowFilter', 'true'], check=True)
+    process = subprocess.Popen(['git', '-C', bare_path, 'fast-import', '--quiet'], stdin=subprocess.PIPE)
+    for chunk in iter_fast_import_stream(commit_count, file_count, layout, files_per_commit):
+        process.stdin.write(chunk)
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"git fast-import failed for {bare_path}")
+    subprocess.run(['git', '-C', bare_path, 'gc', '--quiet'], check=True)
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                pass
+    return total
+
+
+# Create the repositories of the synthetic organization and the search API items describing them
+def create_synthetic_org(bare_dir, repo_count, commit_count, file_count, layouts, files_per_commit):
+    os.makedirs(bare_dir, exist_ok=True)
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    items = []
+    for index in range(repo_count):
+        name = f"repo{index:04d}"
+        layout = layouts[index % len(layouts)]
+        bare_path = os.path.join(bare_dir, f"{name}.git")
+        create_synthetic_repo(bare_path, commit_count, file_count, layout, files_per_commit)
+        # Spread over the last two years, well within the three years repodigger searches
+        pushed_at = (now - timedelta(seconds=(index * 7919 * 3571) % (2 * 365 * 86400))).strftime('%Y-%m-%dT%H:%M:%SZ')
+        items.append({
+            'id': index + 1, 'name': name, 'full_name': f"{BENCH_ORG}/{name}",
+            'clone_url': 'file://' + os.path.abspath(bare_path).replace(os.sep, '/'),
+            'stargazers_count': 1000 + repo_count - index, 'size': directory_size(bare_path) // 1024,
+            'pushed_at': pushed_at, 'updated_at': pushed_at, 'default_branch': 'main',
+            'language': 'Java', 'archived': False,
+        })
+    return items
+
+
+# Serves the GitHub API endpoints repodigger uses for the synthetic items:
+# - GET /search/repositories, honouring the pushed:START..END range used by the search sharding,
+#   paging and the 1000 result limit
+# - GET /repos/{owner}/{repo}/branches/{branch} and /repos/{owner}/{repo}/git/trees/{sha}, read
+#   from the bare repositories, for the pre-clone build system check
+# Responses carry ETags, so revalidation works as with GitHub.
+class StubGitHubHandler(BaseHTTPRequestHandler):
+    items = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_cacheable_json(self, body, resource):
+        etag = '"' + hashlib.sha1(json.dumps(body).encode('utf-8')).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_json(200, body, {'ETag': etag, 'X-RateLimit-Resource': resource, 'X-RateLimit-Remaining': '1000',
+                                   'X-RateLimit-Reset': str(int(time.time()) + 60)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/search/repositories':
+            self.search_repositories(query)
+            return
+        repo_request = re.fullmatch(r'/repos/([^/]+/[^/]+)/(branches|git/trees)/([^/]+)', url.path)
+        item = repo_request and next((item for item in self.items if item['full_name'] == repo_request.group(1)), None)
+        if not item:
+            self.send_json(404, {'message': 'Not Found'})
+            return
+        bare_path = urlparse(item['clone_url']).path
+        if repo_request.group(2) == 'branches':
+            self.branch(bare_path, repo_request.group(3))
+        else:
+            self.tree(bare_path, repo_request.group(3))
+
+    def search_repositories(self, query):
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', ['30'])[0])
+        if (page - 1) * per_page >= repodigger.SEARCH_RESULT_LIMIT:
+            self.send_json(422, {'message': 'Only the first 1000 search results are available'})
+            return
+        matching = self.items
+        pushed_range = re.search(r'pushed:(\S+)\.\.(\S+)', query.get('q', [''])[0])
+        if pushed_range:
+            start, end = pushed_range.groups()
+            matching = [item for item in matching if start <= item['pushed_at'] <= end]
+        matching = sorted(matching, key=lambda item: item['updated_at'], reverse=True)
+        self.send_cacheable_json({'total_count': len(matching), 'incomplete_results': False,
+                                  'items': matching[(page - 1) * per_page:page * per_page]}, 'search')
+
+    def branch(self, bare_path, branch_name):
+        try:
+            commit_sha, tree_sha = subprocess.run(
+                ['git', '-C', bare_path, 'rev-parse', f"refs/heads/{branch_name}", f"refs/heads/{branch_name}^{{tree}}"],
+                capture_output=True, text=True, check=True).stdout.split()
+        except subprocess.CalledProcessError:
+            self.send_json(404, {'message': 'Branch not found'})
+            return
+        self.send_cacheable_json({'name': branch_name, 'commit': {'sha': commit_sha,
+                                                                  'commit': {'tree': {'sha': tree_sha}}}}, 'core')
+
+    def tree(self, bare_path, tree_sha):
+        try:
+            output = subprocess.run(['git', '-C', bare_path, 'ls-tree', '-r', '-t', '-z', tree_sha],
+                                    capture_output=True, check=True).stdout
+        except subprocess.CalledProcessError:
+            self.send_json(404, {'message': 'Not Found'})
+            return
+        entries = []
+        for entry in output.split(b'\0'):
+            if entry:
+                info, _, path = entry.partition(b'\t')
+                mode, object_type, sha = info.decode().split(' ')
+                entries.append({'path': path.decode('utf-8', errors='replace'), 'mode': mode, 'type': object_type, 'sha': sha})
+        self.send_cacheable_json({'sha': tree_sha, 'tree': entries, 'truncated': False}, 'core')
+
+
+def start_stub_api(items):
+    handler = type('BenchGitHubHandler', (StubGitHubHandler,), {'items': items})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class StageTimer:
+    def __init__(self):
+        self.results = []
+
+    def run(self, stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        value = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results.append({'stage': stage, 'seconds': seconds})
+        return value
+
+    def describe(self, **throughput):
+        # Attach the throughput figures and memory high-water mark of the stage that just ran
+        result = self.results[-1]
+        seconds = max(result['seconds'], 1e-9)
+        for unit, amount in throughput.items():
+            result[unit] = amount
+            result[f"{unit}_per_s"] = amount / seconds
+        result['peak_rss_mb'], result['peak_child_rss_mb'] = repodigger.peak_memory_mb()
+
+
+def run_benchmark(args, work_dir):
+    bare_dir = os.path.join(work_dir, "remote")
+    download_dir = os.path.join(work_dir, "download")
+    org_projects_dir = os.path.join(download_dir, f"{BENCH_ORG}-projects")
+    git_log_export_dir = os.path.join(org_projects_dir, "git_log")
+    c4t_dir = os.path.join(git_log_export_dir, "c4t")
+    for directory in (org_projects_dir, c4t_dir):
+        os.makedirs(directory, exist_ok=True)
+    log_file_path = os.path.join(work_dir, "repodigger.log")
+    logging.basicConfig(level=logging.INFO, filename=log_file_path, filemode='w',
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    timer = StageTimer()
+    layouts = args.layouts.split(',')
+    items = timer.run("generate", create_synthetic_org, bare_dir, args.repos, args.commits, args.files, layouts,
+                      args.files_per_commit)
+    timer.describe(repos=len(items), commits=len(items) * args.commits, mb=directory_size(bare_dir) / 1e6)
+
+    disk_budget = None
+    if args.disk_budget is not None:
+        disk_budget = repodigger.DiskBudget(download_dir, args.disk_budget)
+    server, api_url = start_stub_api(items)
+    try:
+        client = repodigger.GitHubClient(repodigger.GITHUB_TOKEN, api_url=api_url,
+                                         cache_dir=os.path.join(org_projects_dir, "api_cache"),
+                                         pool_size=max(10, args.api_workers))
+        pushed_after = datetime.now() - timedelta(days=3 * 365)
+        search_query = f"org:{BENCH_ORG} language:Java archived:false stars:>=0"
+        try:
+            if args.pipeline:
+                # Discovery, pre-check, cloning, build check, export and filtering overlap in one stage
+                final_repos, failed_clones, _, stage_stats = timer.run(
+                    "pipeline", repodigger.run_pipeline, client, search_query, pushed_after, org_projects_dir,
+                    download_dir, args.build_check, args.api_workers, args.clone_workers, args.log_workers,
+                    args.precheck_build_system, args.clone_mode, git_log_export_dir=git_log_export_dir,
+                    c4t_dir=c4t_dir, log_file_path=log_file_path, single_pass=args.single_pass,
+                    keep_full_log=args.keep_full_log, output_format=args.output_format,
+                    mirror_cache_dir=args.mirror_cache, disk_budget=disk_budget)
+                timer.describe(repos=stage_stats['repos'], commits=len(final_repos) * args.commits,
+                               requests=client.stats['requests'])
+            else:
+                repos_with_details = timer.run("discover", repodigger.discover_repositories, client, search_query,
+                                               pushed_after, args.api_workers)
+                timer.describe(repos=len(repos_with_details), requests=client.stats['requests'])
+                if args.precheck_build_system and args.build_check:
+                    requests_before = client.stats['requests']
+                    checked_repos = len(repos_with_details)
+                    repos_with_details, _ = timer.run("precheck", repodigger.precheck_build_systems, client,
+                                                      repos_with_details, None, args.api_workers)
+                    timer.describe(repos=checked_repos, requests=client.stats['requests'] - requests_before)
+        finally:
+            client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if not args.pipeline:
+        if disk_budget is not None:
+            repos_with_details = repodigger.plan_disk_budget(repos_with_details, org_projects_dir, disk_budget,
+                                                             args.clone_priority)
+        final_repos, rejected_paths, failed_clones = timer.run(
+            "clone", repodigger.clone_repositories, repos_with_details, org_projects_dir, download_dir,
+            args.build_check, args.clone_workers, False, args.clone_mode, mirror_cache_dir=args.mirror_cache,
+            disk_budget=disk_budget, fetch_all_objects=True)
+        cloned_paths = [os.path.join(org_projects_dir, name) for name in final_repos] + rejected_paths
+        timer.describe(repos=len(cloned_paths), mb=sum(directory_size(path) for path in cloned_paths) / 1e6)
+
+        # The pipeline checks each repo right after cloning it; this stage repeats the check on its
+        # own over every clone so its cost can be told apart from the clone itself
+        verdicts = timer.run("build_check", lambda: [repodigger.check_build_system_from_tree(path, os.path.basename(path))
+                                                     for path in cloned_paths])
+        timer.describe(repos=len(verdicts))
+        for path in rejected_paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+        timer.run("export_filter", repodigger.analyze_git_logs, final_repos, org_projects_dir, git_log_export_dir,
+                  c4t_dir, args.log_workers, log_file_path, args.single_pass, args.keep_full_log,
+                  output_format=args.output_format)
+        timer.describe(repos=len(final_repos), commits=len(final_repos) * args.commits,
+                       mb=directory_size(git_log_export_dir) / 1e6)
+    if failed_clones:
+        print(f"warning: {len(failed_clones)} clones failed: {failed_clones}", file=sys.stderr)
+    if disk_budget is not None and disk_budget.over_budget:
+        print(f"{len(disk_budget.over_budget)} repos did not fit into the disk budget", file=sys.stderr)
+    test_log_files = sorted(path for path in (os.path.join(c4t_dir, name) for name in os.listdir(c4t_dir))
+                            if path.endswith(f"_test_commit_log.{args.output_format}"))
+
+    all_test_commits_path = repodigger.merged_test_log_path(c4t_dir, args.output_format)
+    merged_rows, _ = timer.run("merge", repodigger.merge_test_commit_logs, test_log_files, all_test_commits_path)
+    timer.describe(rows=merged_rows, mb=sum(os.path.getsize(path) for path in test_log_files) / 1e6)
+
+    return {'config': vars(args), 'stages': timer.results, 'test_commit_rows': merged_rows}
+
+
+def format_report(report):
+    lines = [f"{'stage':<14}{'seconds':>10}  throughput"]
+    for result in report['stages']:
+        throughput = ", ".join(f"{result[unit]:,.1f} {unit.replace('_per_s', '')}/s"
+                               for unit in result if unit.endswith('_per_s'))
+        rss = ""
+        if result.get('peak_rss_mb') is not None:
+            rss = f"  (peak RSS {result['peak_rss_mb']:.0f} MB, children {result['peak_child_rss_mb']:.0f} MB)"
+        lines.append(f"{result['stage']:<14}{result['seconds']:>10.3f}  {throughput}{rss}")
+    lines.append(f"merged test commit rows: {report['test_commit_rows']}")
+    return "\n".join(lines)
+
+
+# Lazy blob fetches of partial clones can start a detached "git gc --auto" that is still
+# writing into a clone when the benchmark ends, so retry the removal for a while
+def remove_work_dir(work_dir, attempts=10):
+    for attempt in range(attempts):
+        try:
+            shutil.rmtree(work_dir)
+            return
+        except OSError:
+            if attempt == attempts - 1:
+                print(f"warning: could not remove {work_dir}", file=sys.stderr)
+                return
+            time.sleep(0.5)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the repodigger pipeline offline against a synthetic organization.")
+    parser.add_argument("--repos", type=int, default=20, help="Number of synthetic repositories.")
+    parser.add_argument("--commits", type=int, default=500, help="Commits per repository.")
+    parser.add_argument("--files", type=int, default=100, help="Source files per repository (a quarter of them are tests).")
+    parser.add_argument("--files-per-commit", type=int, default=3, help="Files modified by each commit.")
+    parser.add_argument("--layouts", default="maven,gradle,maven,ant,mixed",
+                        help=f"Comma-separated build layouts assigned round-robin. Choices: {', '.join(BUILD_LAYOUTS)}.")
+    parser.add_argument("--api-workers", type=int, default=4)
+    parser.add_argument("--clone-workers", type=int, default=1)
+    parser.add_argument("--precheck-build-system", action='store_true',
+                        help="Check build systems through the stub API before cloning.")
+    parser.add_argument("--pipeline", action='store_true',
+                        help="Run discovery, cloning and the git log export as one overlapped pipeline stage.")
+    parser.add_argument("--clone-mode", choices=sorted(repodigger.CLONE_MODE_OPTIONS), default='full')
+    parser.add_argument("--mirror-cache", type=os.path.abspath,
+                        help="Clone through shared mirrors in this directory; reuse it together with --work-dir.")
+    parser.add_argument("--disk-budget", type=repodigger.parse_size)
+    parser.add_argument("--clone-priority", choices=repodigger.CLONE_PRIORITIES, default='stars')
+    parser.add_argument("--log-workers", type=int, default=1)
+    parser.add_argument("--single-pass", action='store_true')
+    parser.add_argument("--keep-full-log", action='store_true')
+    parser.add_argument("--output-format", choices=repodigger.OUTPUT_FORMATS, default='csv')
+    parser.add_argument("--no-build-check", dest='build_check', action='store_false',
+                        help="Keep every clone, as with --disable-build-system-check.")
+    parser.add_argument("--work-dir", help="Directory for the generated data. Default: a temporary directory that is removed afterwards.")
+    parser.add_argument("--json", dest='json_path', help="Also write the results as JSON to this file.")
+    args = parser.parse_args()
+    if args.output_format == 'parquet' and repodigger.pq is None:
+        parser.error("--output-format parquet needs pyarrow")
+
+    unknown_layouts = set(args.layouts.split(',')) - set(BUILD_LAYOUTS)
+    if unknown_layouts:
+        parser.error(f"unknown build layouts: {', '.join(sorted(unknown_layouts))}")
+    if args.commits < 1 or args.files < 1:
+        parser.error("--commits and --files must be at least 1")
+
+    if args.work_dir:
+        if os.path.exists(args.work_dir) and os.listdir(args.work_dir):
+            parser.error(f"--work-dir {args.work_dir} is not empty")
+        os.makedirs(args.work_dir, exist_ok=True)
+        report = run_benchmark(args, args.work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="repodigger-bench-")
+        try:
+            report = run_benchmark(args, work_dir)
+        finally:
+            remove_work_dir(work_dir)
+
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,5 +1,9 @@
 import argparse
-from datetime import datetime, timedelta
+import contextlib
+import cProfile
+import functools
+import pstats
+from datetime import datetime, timedelta, timezone
 from git import Repo
 import pandas as pd
 import os
@@ -7,11 +11,34 @@ import csv
 import subprocess
 import logging
 import shutil
+import sqlite3
 import glob
+import hashlib
+import json
+import queue
+import re
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from urllib.parse import quote, urlsplit
 
 import requests
 
+try:
+    import resource
+except ImportError: # Not available on Windows; peak memory is then not reported
+    resource = None
+
+# Optional: only needed for --output-format parquet (pip install "repodigger[parquet]")
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
 # Attempt to get GITHUB_TOKEN from environment variable first
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
 
@@ -36,19 +63,8 @@ if not GITHUB_TOKEN:
     print("ERROR: GITHUB_TOKEN is empty. Please ensure it has a value in the environment variable or SECRET.py.", file=sys.stderr)
     raise ValueError("GITHUB_TOKEN is empty.")
 
-# Main script execution
-def main(org_name, min_stars, download_folder_base, export_git_log, language, disable_build_system_check):
-    # Create the base download dir if it doesn't exist
-    if not os.path.exists(download_folder_base):
-        os.makedirs(download_folder_base)
-
-    # Create the specific dir for the organization within the download folder
-    org_projects_dir = os.path.join(download_folder_base, org_name + "-projects")
-    if not os.path.exists(org_projects_dir):
-        os.makedirs(org_projects_dir)
-
+def configure_logging(log_file_path):
     # Set log level and file path
-    log_file_path = os.path.join(org_projects_dir, 'repodigger.log')
     logging.basicConfig(level=logging.INFO,
                         filename=log_file_path,
                         filemode='a',  # Append to the log file if it exists
@@ -61,189 +77,2424 @@ def main(org_name, min_stars, download_folder_base, export_git_log, language, di
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
 
-    logging.info(f"Starting repodigger for organization: {org_name}")
-    logging.info(f"Minimum stars: {min_stars}")
-    logging.info(f"Language filter: {language}")
-    logging.info(f"Download folder: {org_projects_dir}")
 
-    # Determine if build system check should be performed
-    perform_build_check = False
-    if language.lower() == 'java':
-        if not disable_build_system_check:
-            perform_build_check = True
-            logging.info("Build system check is ENABLED for Java projects.")
-        else:
-            logging.info("Build system check is EXPLICITLY DISABLED via --disable-build-system-check flag for Java projects.")
-    else:
-        logging.warning(f"Build system check is AUTOMATICALLY DISABLED for non-Java language: {language}. All cloned repositories for this language will be kept regardless of their build system (if any).")
+# Worker processes started with "spawn" (the default on Windows and macOS) do not inherit
+# the logging setup of the main process, so configure it again if nothing is set up yet.
+def init_worker_logging(log_file_path):
+    if log_file_path and not logging.getLogger('').handlers:
+        configure_logging(log_file_path)
 
-    # Get the project list from the GitHub API
-    logging.info("=== Getting the project list from the GitHub API ===")
-    # Calculate three years ago for the pushed date query
-    three_years_ago = (datetime.now() - timedelta(days=3*365)).strftime('%Y-%m-%d') # Approximate 3 years
-    # Updated query to include stars>=min_stars and pushed date within last 3 years, and use language parameter
-    base_url = f"https://api.github.com/search/repositories?q=org:{org_name}+language:{language}+archived:false+pushed:>{three_years_ago}+stars:>={min_stars}&sort=updated&order=desc"
 
-    headers = {'Authorization': f'token {GITHUB_TOKEN}'}
+# Peak resident set size in MB of this process and of its finished child processes
+# (git, log workers), or None where it cannot be measured
+def peak_memory_mb():
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
 
-    def get_repos_from_api(url):
-        all_repos_details = []
-        page = 1
-        while True:
-            paginated_url = f"{url}&page={page}&per_page=100" # Max 100 per page
-            response = requests.get(paginated_url, headers=headers)
+
+# Machine-readable metrics of a run, appended to <org>-projects/metrics.jsonl when the run ends.
+# Every line is one JSON object tagged with the run id: a "stage" record per pipeline stage,
+# a "repo" record per repository and stage, and a final "run" record.
+METRICS_FILE = "metrics.jsonl"
+
+
+class RunMetrics:
+    def __init__(self, path):
+        self.path = path
+        self.run_id = datetime.now().isoformat(timespec='seconds')
+        self.records = []
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(dict(record, run=self.run_id))
+
+    # Time a stage; counters can be added to the yielded dict while it runs
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {'type': 'stage', 'stage': name}
+        stage_start = time.time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.time() - stage_start, 3)
+            record['peak_rss_mb'], record['peak_child_rss_mb'] = peak_memory_mb()
+            self._add(record)
+            logging.info(f"Stage {name} took {record['seconds']:.1f}s.")
+
+    def record_repo(self, stage, repo_name, **fields):
+        self._add(dict({'type': 'repo', 'stage': stage, 'repo': repo_name}, **fields))
+
+    def write(self, **summary):
+        record = dict({'type': 'run', 'seconds': round(time.time() - self._start, 3)}, **summary)
+        record['peak_rss_mb'], record['peak_child_rss_mb'] = peak_memory_mb()
+        self._add(record)
+        try:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                for metrics_record in self.records:
+                    file.write(json.dumps(metrics_record) + "\n")
+            logging.info(f"Run metrics saved to {self.path}")
+        except OSError as e:
+            logging.warning(f"Could not write run metrics to {self.path}. Reason: {e}")
+
+
+def record_repo_metrics(metrics, stage, repo_name, **fields):
+    if metrics is not None:
+        metrics.record_repo(stage, repo_name, **fields)
+
+
+# Logs "done/total" progress with an ETA while a stage works through its repositories.
+# Lines are logged at most every PROGRESS_LOG_INTERVAL seconds, and always for the last item.
+PROGRESS_LOG_INTERVAL = 10
+
+
+class ProgressTracker:
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self._start = time.time()
+        self._last_logged = None
+        self._lock = threading.Lock()
+
+    # Grow the total while items are still being discovered (--pipeline)
+    def add(self, count=1):
+        with self._lock:
+            self.total += count
+
+    def advance(self, item_name=None):
+        with self._lock:
+            self.done += 1
+            now = time.time()
+            if self.done < self.total and self._last_logged is not None and now - self._last_logged < PROGRESS_LOG_INTERVAL:
+                return
+            self._last_logged = now
+            elapsed = now - self._start
+            eta = elapsed / self.done * (self.total - self.done)
+            last_item = f" (last: {item_name})" if item_name else ""
+            logging.info(f"{self.label}: {self.done}/{self.total} ({self.done * 100 // max(1, self.total)}%), "
+                         f"elapsed {format_duration(elapsed)}, ETA {format_duration(eta)}{last_item}")
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+# --profile: the hot functions decorated with @profiled run under cProfile, and their statistics
+# are accumulated per function and process in <dir>/<function>.<pid>.prof (load them with pstats).
+# The directory is passed through the environment so log worker processes profile too.
+# Only one profiler can be active at a time, so a call made while another thread is being
+# profiled runs unprofiled.
+PROFILE_DIR_ENV = 'REPODIGGER_PROFILE_DIR'
+_profile_lock = threading.Lock()
+_profile_stats = {}
+
+
+def enable_profiling(profile_dir):
+    os.makedirs(profile_dir, exist_ok=True)
+    os.environ[PROFILE_DIR_ENV] = os.path.abspath(profile_dir)
+
+
+def profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile_dir = os.environ.get(PROFILE_DIR_ENV)
+        if not profile_dir or not _profile_lock.acquire(blocking=False):
+            return function(*args, **kwargs)
+        try:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError: # Another profiling tool is already active
+                return function(*args, **kwargs)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.disable()
+                stats = _profile_stats.get(function.__name__)
+                if stats is None:
+                    stats = _profile_stats[function.__name__] = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+                try:
+                    stats.dump_stats(os.path.join(profile_dir, f"{function.__name__}.{os.getpid()}.prof"))
+                except OSError as e:
+                    logging.warning(f"Could not write profile of {function.__name__}. Reason: {e}")
+        finally:
+            _profile_lock.release()
+    return wrapper
+
+
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+
+# The search API never returns more than this many results for a single query
+SEARCH_RESULT_LIMIT = 1000
+SEARCH_PAGE_SIZE = 100 # Max 100 per page
+
+
+class GitHubAPIError(Exception):
+    pass
+
+
+# Small GitHub REST client shared by all API calls of a run.
+# - Connections are pooled through one requests.Session.
+# - Responses with an ETag or Last-Modified header are cached on disk and revalidated with
+#   If-None-Match / If-Modified-Since, so unchanged pages come back as 304 Not Modified,
+#   which does not count against the rate limit.
+# - The X-RateLimit-* headers are tracked per resource (search/core). When a limit is used up
+#   the client waits for its reset instead of failing, and retries rate-limited responses
+#   (403/429) and server errors before giving up with a GitHubAPIError.
+class GitHubClient:
+    def __init__(self, token, api_url=GITHUB_API_URL, cache_dir=None, max_retries=5, pool_size=10, timeout=30):
+        self.api_url = api_url.rstrip('/')
+        self.cache_dir = cache_dir
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Authorization': f'token {token}', 'Accept': 'application/vnd.github+json'})
+        self.sleep = time.sleep
+        self._rate_limits = {} # resource -> (remaining, reset epoch seconds)
+        self._rate_limit_lock = threading.Lock()
+        self.stats = {'requests': 0, 'not_modified': 0, 'rate_limit_waits': 0}
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def close(self):
+        self.session.close()
+
+    @profiled
+    def get_json(self, path, params=None):
+        url = path if path.startswith(('http://', 'https://')) else self.api_url + path
+        full_url = requests.Request('GET', url, params=params).prepare().url
+        resource = 'search' if '/search/' in full_url else 'core'
+        cached = self._load_cached(full_url)
+
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit(resource)
+            headers = {}
+            if cached:
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+            try:
+                response = self.session.get(full_url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise GitHubAPIError(f"Request to {full_url} failed. Reason: {e}") from e
+                self._backoff(attempt, f"Request to {full_url} failed ({e})")
+                continue
+            self._count('requests')
+            self._record_rate_limit(resource, response)
+
+            if response.status_code == 304 and cached:
+                self._count('not_modified')
+                return cached['body']
             if response.status_code == 200:
-                data = response.json()
-                current_page_repos = data['items']
-                if not current_page_repos: # No more repos
-                    break
-                all_repos_details.extend(current_page_repos)
-                if len(current_page_repos) < 100: # Last page
+                body = response.json()
+                self._store_cached(full_url, response, body)
+                return body
+            if response.status_code in (403, 429) and self._is_rate_limited(response):
+                if attempt == self.max_retries:
                     break
-                page += 1
-            else:
-                logging.error(f"Failed to retrieve repositories (page {page}): {response.status_code} - {response.text}")
+                self._wait_after_rate_limit(resource, response)
+                continue
+            if response.status_code >= 500 and attempt < self.max_retries:
+                self._backoff(attempt, f"GitHub API returned {response.status_code} for {full_url}")
+                continue
+            raise GitHubAPIError(f"{response.status_code} - {response.text}")
+        raise GitHubAPIError(f"Giving up on {full_url} after {self.max_retries + 1} attempts.")
+
+    # Yields the items of every page of a search; stops at the last page or the search result limit
+    def iter_search_pages(self, kind, query, sort=None, order=None, per_page=SEARCH_PAGE_SIZE):
+        page = 1
+        while True:
+            params = {'q': query, 'page': page, 'per_page': per_page}
+            if sort:
+                params['sort'] = sort
+            if order:
+                params['order'] = order
+            data = self.get_json(f"/search/{kind}", params)
+            items = data.get('items', [])
+            if data.get('incomplete_results'):
+                logging.warning(f"GitHub reported incomplete search results for '{query}' (page {page}).")
+            if items:
+                yield items
+            available = min(data.get('total_count', 0), SEARCH_RESULT_LIMIT)
+            if len(items) < per_page or page * per_page >= available: # Last page
                 break
+            page += 1
+
+    def search_repositories(self, query, sort=None, order=None):
+        all_repos_details = []
+        for items in self.iter_search_pages('repositories', query, sort, order):
+            all_repos_details.extend(items)
         return all_repos_details
 
-    repos_with_details = get_repos_from_api(base_url)
-    logging.info(f"Retrieved {len(repos_with_details)} repositories from API before build system check.")
+    def _count(self, key):
+        with self._rate_limit_lock:
+            self.stats[key] += 1
+
+    def _cache_path(self, full_url):
+        return os.path.join(self.cache_dir, hashlib.sha256(full_url.encode('utf-8')).hexdigest() + ".json")
+
+    def _load_cached(self, full_url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(full_url), encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _store_cached(self, full_url, response, body):
+        if not self.cache_dir:
+            return
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        cache_path = self._cache_path(full_url)
+        # Written under a unique name first so concurrent requests never read half a file
+        partial_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.partial"
+        try:
+            with open(partial_path, 'w', encoding='utf-8') as file:
+                json.dump({'url': full_url, 'etag': etag, 'last_modified': last_modified, 'body': body}, file)
+            os.replace(partial_path, cache_path)
+        except OSError as e:
+            logging.warning(f"Could not cache GitHub API response for {full_url}. Reason: {e}")
+
+    def _record_rate_limit(self, resource, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        resource = response.headers.get('X-RateLimit-Resource', resource)
+        with self._rate_limit_lock:
+            self._rate_limits[resource] = (int(remaining), int(reset))
+
+    def _wait_for_rate_limit(self, resource):
+        with self._rate_limit_lock:
+            remaining, reset = self._rate_limits.get(resource, (None, None))
+        if remaining == 0:
+            wait_seconds = reset - time.time() + 1
+            if wait_seconds > 0:
+                self._count('rate_limit_waits')
+                logging.warning(f"GitHub {resource} rate limit used up. Waiting {wait_seconds:.0f}s for it to reset.")
+                self.sleep(wait_seconds)
+            with self._rate_limit_lock:
+                # Assume the limit was refilled until the next response says otherwise
+                if self._rate_limits.get(resource, (None, None))[1] == reset:
+                    self._rate_limits.pop(resource, None)
+
+    @staticmethod
+    def _is_rate_limited(response):
+        return (response.headers.get('X-RateLimit-Remaining') == '0'
+                or 'Retry-After' in response.headers
+                or 'rate limit' in response.text.lower())
+
+    def _wait_after_rate_limit(self, resource, response):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            # Secondary rate limits tell us how long to wait
+            self._count('rate_limit_waits')
+            wait_seconds = max(int(retry_after), 1)
+            logging.warning(f"GitHub secondary rate limit hit. Waiting {wait_seconds}s before retrying.")
+            self.sleep(wait_seconds)
+        elif response.headers.get('X-RateLimit-Remaining') == '0':
+            self._wait_for_rate_limit(resource)
+        else:
+            self._count('rate_limit_waits')
+            logging.warning("GitHub rate limit hit without reset information. Waiting 60s before retrying.")
+            self.sleep(60)
+
+    def _backoff(self, attempt, reason):
+        wait_seconds = min(2 ** attempt, 60)
+        logging.warning(f"{reason}. Retrying in {wait_seconds}s...")
+        self.sleep(wait_seconds)
+
+
+# Search shards are never split below this span of pushed: time
+MIN_SEARCH_SHARD_SPAN = timedelta(minutes=1)
+
+
+def format_search_time(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# Yield every repository matching base_query that was pushed after pushed_after (a datetime, UTC).
+# A single search query stops at 1000 results, so the pushed: date range is split in halves until
+# every shard reports at most 1000 results. Shards never overlap (both ends of a GitHub range are
+# inclusive, so the second half starts one second after the first ends). The first page of a
+# shard tells whether it needs splitting; its remaining pages, and the pages of all other shards,
+# are fetched concurrently. Repositories are de-duplicated by id, since a repo pushed while the
+# search runs can move from one shard to another.
+def iter_discovered_repositories(client, base_query, pushed_after, api_workers=4, sort='updated', order='desc'):
+    # Whole days keep the shard URLs identical between runs on the same day, so the API cache can revalidate them
+    today = datetime.now(timezone.utc).replace(tzinfo=None).replace(hour=0, minute=0, second=0, microsecond=0)
+    pushed_before = today + timedelta(days=2)
+    seen_repo_ids = set()
+
+    def fetch_page(shard, page):
+        start, end = shard
+        params = {'q': f"{base_query} pushed:{format_search_time(start)}..{format_search_time(end)}",
+                  'page': page, 'per_page': SEARCH_PAGE_SIZE, 'sort': sort, 'order': order}
+        return client.get_json("/search/repositories", params)
+
+    with ThreadPoolExecutor(max_workers=max(1, api_workers)) as executor:
+        first_shard = (pushed_after, pushed_before)
+        pending = {executor.submit(fetch_page, first_shard, 1): (first_shard, 1)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard, page = pending.pop(future)
+                try:
+                    data = future.result()
+                except GitHubAPIError:
+                    for other_future in pending:
+                        other_future.cancel()
+                    raise
+                start, end = shard
+                if page == 1:
+                    total_count = data.get('total_count', 0)
+                    if total_count > SEARCH_RESULT_LIMIT and end - start >= 2 * MIN_SEARCH_SHARD_SPAN:
+                        # Too many results for one query: search both halves instead
+                        middle = start + timedelta(seconds=int((end - start).total_seconds() // 2))
+                        for half in ((start, middle), (middle + timedelta(seconds=1), end)):
+                            pending[executor.submit(fetch_page, half, 1)] = (half, 1)
+                        continue
+                    if total_count > SEARCH_RESULT_LIMIT:
+                        logging.warning(f"{total_count} repositories were pushed between {format_search_time(start)} and "
+                                        f"{format_search_time(end)}; only the first {SEARCH_RESULT_LIMIT} can be retrieved.")
+                    last_page = -(-min(total_count, SEARCH_RESULT_LIMIT) // SEARCH_PAGE_SIZE)
+                    for next_page in range(2, last_page + 1):
+                        pending[executor.submit(fetch_page, shard, next_page)] = (shard, next_page)
+                if data.get('incomplete_results'):
+                    logging.warning(f"GitHub reported incomplete search results for pushed:{format_search_time(start)}.."
+                                    f"{format_search_time(end)} (page {page}).")
+                for repo_detail in data.get('items', []):
+                    if repo_detail['id'] not in seen_repo_ids:
+                        seen_repo_ids.add(repo_detail['id'])
+                        yield repo_detail
+
+
+def discover_repositories(client, base_query, pushed_after, api_workers=4):
+    repos_with_details = list(iter_discovered_repositories(client, base_query, pushed_after, api_workers))
+    # Shards finish in any order; restore the "recently updated first" order of a single search
+    repos_with_details.sort(key=lambda repo_detail: repo_detail.get('updated_at') or '', reverse=True)
+    return repos_with_details
+
+
+# Persistent per-repository pipeline state, kept in <org>-projects/repodigger_state.sqlite.
+# Each row records how far a repository got (its stage), the HEAD it was at, the cached build
+# system verdict and how long each step took, so reruns can skip finished work and resume
+# where an earlier run stopped. Stages, in order: discovered, cloning (a clone in progress;
+# seen on a later run it means the clone was interrupted), cloned, checked (or rejected /
+# failed), exported and filtered.
+# All writes are committed immediately, so the state survives crashes. Clone worker threads
+# share the connection; the git log worker processes report back to the main process instead
+# of writing themselves.
+STATE_STORE_FILE = "repodigger_state.sqlite"
+
+
+class PipelineStateStore:
+    COLUMNS = ['name', 'full_name', 'stage', 'head_sha', 'build_verdict', 'build_verdict_sha',
+               'build_verdict_pushed_at', 'exported_sha', 'test_commit_status', 'clone_seconds',
+               'check_seconds', 'export_seconds', 'error', 'updated_at']
+
+    def __init__(self, path, reuse=True):
+        self.path = path
+        # With reuse=False the store is still written but never consulted (--ignore-state)
+        self.reuse = reuse
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS repos (
+                    name TEXT PRIMARY KEY,
+                    full_name TEXT,
+                    stage TEXT NOT NULL,
+                    head_sha TEXT,
+                    build_verdict INTEGER,
+                    build_verdict_sha TEXT,
+                    build_verdict_pushed_at TEXT,
+                    exported_sha TEXT,
+                    test_commit_status TEXT,
+                    clone_seconds REAL,
+                    check_seconds REAL,
+                    export_seconds REAL,
+                    error TEXT,
+                    updated_at TEXT
+                )""")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get(self, repo_name):
+        if not self.reuse:
+            return None
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM repos WHERE name = ?", (repo_name,)).fetchone()
+        return dict(row) if row else None
+
+    # The recorded stage of a repo, also with reuse=False: --ignore-state redoes the work, but a
+    # clone an earlier run left in the 'cloning' stage must still be recognized as incomplete
+    def stage(self, repo_name):
+        with self._lock:
+            row = self._connection.execute("SELECT stage FROM repos WHERE name = ?", (repo_name,)).fetchone()
+        return row['stage'] if row else None
+
+    def update(self, repo_name, **fields):
+        unknown = set(fields) - set(self.COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown state columns: {sorted(unknown)}")
+        fields['updated_at'] = datetime.now().isoformat(timespec='seconds')
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO repos (name, stage) VALUES (?, 'discovered')", (repo_name,))
+            self._connection.execute(f"UPDATE repos SET {assignments} WHERE name = ?", list(fields.values()) + [repo_name])
 
+    # Add newly discovered repositories; repositories known from earlier runs keep their state
+    def mark_discovered(self, repos_with_details):
+        now = datetime.now().isoformat(timespec='seconds')
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO repos (name, full_name, stage, updated_at) VALUES (?, ?, 'discovered', ?)",
+                [(repo_detail['name'], repo_detail.get('full_name'), now) for repo_detail in repos_with_details])
+
+    # Repos whose export and test commit filtering finished for the HEAD they are at now,
+    # mapped to their filter status ("saved" or "no_test_commits"). Pass repo_name to only
+    # look at that repo.
+    def finished_exports(self, repo_name=None):
+        if not self.reuse:
+            return {}
+        query = ("SELECT name, test_commit_status FROM repos WHERE exported_sha IS NOT NULL "
+                 "AND exported_sha = head_sha AND test_commit_status IS NOT NULL")
+        parameters = ()
+        if repo_name is not None:
+            query += " AND name = ?"
+            parameters = (repo_name,)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return {row['name']: row['test_commit_status'] for row in rows}
+
+
+def record_repo_state(state_store, repo_name, **fields):
+    if state_store is not None:
+        state_store.update(repo_name, **fields)
+
+
+def current_head_sha(repo_path):
+    try:
+        return run_git(repo_path, 'rev-parse', 'HEAD')
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+# Check the build system of a clone, reusing the verdict stored for the same HEAD commit
+def check_build_system_cached(repo_path, repo_name, head_sha, repo_detail, repo_state, state_store):
+    if head_sha and repo_state and repo_state.get('build_verdict') is not None and repo_state.get('build_verdict_sha') == head_sha:
+        qualifies = bool(repo_state['build_verdict'])
+        logging.info(f"Repo {repo_name}: reusing build system verdict for {head_sha[:7]} ({'qualifying' if qualifies else 'excluded'}).")
+        return qualifies
+    check_start = time.time()
+    qualifies = check_build_system_from_tree(repo_path, repo_name)
+    record_repo_state(state_store, repo_name, build_verdict=int(qualifies), build_verdict_sha=head_sha,
+                      build_verdict_pushed_at=repo_detail.get('pushed_at'), check_seconds=time.time() - check_start)
+    return qualifies
+
+
+# Stop cloning once the download volume is more than this percentage full
+DISK_USAGE_LIMIT_PERCENT = 90
+
+# Serializes the post-clone disk usage checks of concurrent clone workers
+_disk_check_lock = threading.Lock()
+
+
+# Run a git command inside a repository and return its stripped stdout
+def run_git(repo_path, *args):
+    result = subprocess.run(['git', '-C', repo_path] + list(args), capture_output=True, text=True,
+                            check=True, encoding='utf-8', errors='replace')
+    return result.stdout.strip()
+
+
+# Bring an existing clone up to date with its upstream branch. A clone is only ever a copy of
+# upstream, so if the branch was force-pushed the local branch is simply reset to it.
+def update_existing_clone(repo_path, repo_name):
+    run_git(repo_path, 'fetch', '--quiet', 'origin')
+    try:
+        run_git(repo_path, 'merge', '--ff-only', '--quiet', '@{upstream}')
+    except subprocess.CalledProcessError:
+        logging.warning(f"Repo {repo_name}: upstream history was rewritten. Resetting to upstream.")
+        run_git(repo_path, 'reset', '--hard', '--quiet', '@{upstream}')
+    logging.info(f"Repo {repo_name} updated to {run_git(repo_path, 'rev-parse', '--short', 'HEAD')}.")
+
+
+# --mirror-cache: bare mirrors of the cloned repositories in a directory that is shared by all
+# runs, organizations and download folders, at <cache>/<host>/<path of the clone URL>.git.
+# A mirror holds the branches and tags of its repository and is brought up to date with a fetch,
+# so a repository is downloaded in full only once; later runs transfer new objects only.
+# Working clones borrow the mirror's objects through git alternates (git clone --shared), so
+# they only store their checkout and index. Mirrors never prune unreachable objects
+# (gc.pruneExpire=never), since working clones may still use objects of deleted branches.
+def mirror_path(mirror_cache_dir, clone_url):
+    parsed = urlsplit(clone_url)
+    if parsed.scheme:
+        location = f"{parsed.hostname or 'local'}/{parsed.path}"
+    else: # scp-like syntax: git@host:owner/repo.git
+        location = clone_url.split('@', 1)[-1].replace(':', '/', 1)
+    parts = [re.sub(r'[^A-Za-z0-9._-]', '_', part) for part in location.split('/') if part not in ('', '.', '..')]
+    name = parts[-1][:-len('.git')] if parts[-1].endswith('.git') else parts[-1]
+    return os.path.join(mirror_cache_dir, *parts[:-1], name + '.git')
+
+
+# One lock per mirror, so two clone workers never fetch into the same mirror at once
+_mirror_locks = {}
+_mirror_locks_lock = threading.Lock()
+
+
+# Create or update the mirror of a repository and return its path. A new mirror is fetched
+# into a temporary directory and moved into place when complete, so an interrupted run never
+# leaves a partial mirror behind.
+def update_mirror(mirror_dir, clone_url, default_branch=None):
+    with _mirror_locks_lock:
+        mirror_lock = _mirror_locks.setdefault(mirror_dir, threading.Lock())
+    with mirror_lock:
+        if os.path.isdir(mirror_dir):
+            run_git(mirror_dir, 'fetch', '--prune', '--quiet', 'origin')
+        else:
+            os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+            partial_dir = tempfile.mkdtemp(prefix=os.path.basename(mirror_dir) + '.', suffix='.partial',
+                                           dir=os.path.dirname(mirror_dir))
+            try:
+                run_git(partial_dir, 'init', '--bare', '--quiet')
+                run_git(partial_dir, 'remote', 'add', 'origin', clone_url)
+                # Only branches and tags; GitHub's refs/pull/* would add every pull request
+                run_git(partial_dir, 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*')
+                run_git(partial_dir, 'config', '--add', 'remote.origin.fetch', '+refs/tags/*:refs/tags/*')
+                run_git(partial_dir, 'config', 'gc.pruneExpire', 'never')
+                run_git(partial_dir, 'fetch', '--quiet', 'origin')
+                os.rename(partial_dir, mirror_dir)
+            except OSError:
+                # Another process created the mirror in the meantime
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                if not os.path.isdir(mirror_dir):
+                    raise
+            except subprocess.CalledProcessError:
+                shutil.rmtree(partial_dir, ignore_errors=True)
+                raise
+        # Clones check out the mirror's HEAD, so point it at the default branch
+        if default_branch:
+            run_git(mirror_dir, 'symbolic-ref', 'HEAD', f"refs/heads/{default_branch}")
+    return mirror_dir
+
+
+# Update the mirror of a repository for a clone, recording the time it took and by how many
+# bytes the mirror grew (all of it for a new mirror)
+def update_repo_mirror(repo_detail, mirror_cache_dir, repo_metrics):
+    mirror_dir = mirror_path(mirror_cache_dir, repo_detail['clone_url'])
+    mirror_start = time.time()
+    bytes_before = directory_bytes(mirror_dir)
+    update_mirror(mirror_dir, repo_detail['clone_url'], repo_detail.get('default_branch'))
+    repo_metrics['mirror_seconds'] = round(time.time() - mirror_start, 3)
+    repo_metrics['mirror_bytes'] = max(0, directory_bytes(mirror_dir) - bytes_before)
+    return mirror_dir
+
+
+# Build files that identify a build system, by file name anywhere in the project
+MAVEN_BUILD_FILES = frozenset(["pom.xml"])
+GRADLE_BUILD_FILES = frozenset(["build.gradle", "build.gradle.kts"])
+ANT_BUILD_FILES = frozenset(["build.xml"])
+BAZEL_BUILD_FILES = frozenset(["WORKSPACE", "BUILD", "BUILD.bazel"])
+BUILD_FILE_NAMES = MAVEN_BUILD_FILES | GRADLE_BUILD_FILES | ANT_BUILD_FILES | BAZEL_BUILD_FILES
+
+# git clone options per --clone-mode. Partial clones download commits (and trees) only; the
+# missing objects are fetched on demand when git needs them.
+CLONE_MODE_OPTIONS = {
+    'full': [],
+    'blobless': ['--filter=blob:none'],
+    'treeless': ['--filter=tree:0'],
+}
+
+
+# git log --numstat reads the blobs of every commit, which a partial clone fetches on demand,
+# one commit at a time. Before a partial clone is exported, fetch everything it is missing in a
+# single fetch instead (git >= 2.36), and stop filtering its later fetches. The filter is only
+# removed once the fetch succeeded, so a failed or interrupted fetch is retried by the next run.
+# Returns False for full clones.
+def fetch_missing_objects(repo_path, repo_name):
+    try:
+        run_git(repo_path, 'config', '--get', 'remote.origin.partialclonefilter')
+    except subprocess.CalledProcessError:
+        return False
+    logging.info(f"Repo {repo_name}: fetching the objects its partial clone left out for the git log export...")
+    run_git(repo_path, 'fetch', '--refetch', '--no-filter', '--quiet', 'origin')
+    run_git(repo_path, 'config', '--unset', 'remote.origin.partialclonefilter')
+    return True
+
+
+# Decide whether a project qualifies from the names of the files it contains
+def evaluate_build_files(file_names, repo_name_for_log):
+    file_names = set(file_names)
+    found_maven = not MAVEN_BUILD_FILES.isdisjoint(file_names)
+    found_gradle = not GRADLE_BUILD_FILES.isdisjoint(file_names)
+    found_ant = not ANT_BUILD_FILES.isdisjoint(file_names)
+    found_bazel = not BAZEL_BUILD_FILES.isdisjoint(file_names)
+    
+    # Decision logic based on found files
+    if (found_maven or found_gradle) and not (found_ant or found_bazel):
+        build_system = []
+        if found_maven:
+            build_system.append("Maven")
+        if found_gradle:
+            build_system.append("Gradle")
+        logging.info(f"Repo {repo_name_for_log}: Found {' and '.join(build_system)}. Qualifying build system.")
+        return True
+    else:
+        reasons = []
+        if not (found_maven or found_gradle):
+            reasons.append("Neither Maven nor Gradle found anywhere in the project")
+        if found_ant:
+            reasons.append("Ant build file (build.xml) detected")
+        if found_bazel:
+            reasons.append("Bazel build file (WORKSPACE, BUILD, or BUILD.bazel) detected")
+        
+        # More specific logging if both desired and undesired systems are found
+        if (found_maven or found_gradle) and (found_ant or found_bazel):
+             reasons.append("Project contains a mix of desired (Maven/Gradle) and undesired (Ant/Bazel) build systems.")
+
+        logging.warning(f"Repo {repo_name_for_log}: Build system check failed. Reasons: {'; '.join(reasons)}. Excluding.")
+        return False
+
+
+# Function to check build system on a checked-out directory
+def check_build_system(repo_clone_path, repo_name_for_log):
+    # Traverse the directory tree to find build files
+    found_build_files = set()
+    for root, dirs, files in os.walk(repo_clone_path):
+        # Skip .git directory to avoid issues and speed up search
+        if ".git" in dirs:
+            dirs.remove(".git")
+        found_build_files.update(BUILD_FILE_NAMES.intersection(files))
+    return evaluate_build_files(found_build_files, repo_name_for_log)
+
+
+# Names of the build files among the file paths of a git tree ('/'-separated)
+def build_files_in_paths(paths):
+    return {path.rsplit('/', 1)[-1] for path in paths} & BUILD_FILE_NAMES
+
+
+# Names of the build files in the tree of a commit. Only needs commits and trees, so it works
+# on clones without a checkout and never touches file contents.
+def list_tree_build_files(repo_path, revision='HEAD'):
+    output = subprocess.run(['git', '-C', repo_path, 'ls-tree', '-r', '-z', revision],
+                            capture_output=True, check=True).stdout
+    blob_paths = []
+    for entry in output.split(b'\0'):
+        if not entry:
+            continue
+        # "<mode> <type> <object>\t<path>"; submodules are "commit" entries, not files
+        info, _, path = entry.partition(b'\t')
+        if info.split(b' ')[1] == b'blob':
+            blob_paths.append(path.decode('utf-8', errors='replace'))
+    return build_files_in_paths(blob_paths)
+
+
+# Check the build system from the file listing of HEAD instead of walking the working tree.
+# Falls back to walking the directory if it is not a usable git repository.
+def check_build_system_from_tree(repo_path, repo_name_for_log):
+    try:
+        found_build_files = list_tree_build_files(repo_path)
+    except (subprocess.CalledProcessError, OSError):
+        return check_build_system(repo_path, repo_name_for_log)
+    return evaluate_build_files(found_build_files, repo_name_for_log)
+
+
+# Pre-clone build system check (--precheck-build-system): decide from the file tree of the
+# default branch as listed by the GitHub API, so rejected repositories are never cloned. The
+# tree API lists the same blob entries as `git ls-tree -r`, and the decision is made by
+# evaluate_build_files, so the verdict is the one the clone would get.
+# Returns True or False, or None when undecided (the tree listing is truncated or could not be
+# fetched); undecided repositories are cloned and checked as before. Verdicts are stored with
+# the commit they were made for, and reused while the repository has not been pushed to.
+def remote_build_verdict(client, repo_detail, state_store=None):
+    repo_name = repo_detail['name']
+    repo_state = state_store.get(repo_name) if state_store is not None else None
+    if (repo_state and repo_state.get('build_verdict') is not None and repo_detail.get('pushed_at')
+            and repo_state.get('build_verdict_pushed_at') == repo_detail['pushed_at']):
+        logging.info(f"Repo {repo_name}: not pushed to since its last build system check. Reusing the verdict.")
+        return bool(repo_state['build_verdict'])
+    full_name = repo_detail.get('full_name')
+    default_branch = repo_detail.get('default_branch')
+    if not full_name or not default_branch:
+        return None
+
+    try:
+        branch = client.get_json(f"/repos/{full_name}/branches/{quote(default_branch, safe='')}")
+        commit_sha = branch['commit']['sha']
+        if repo_state and repo_state.get('build_verdict') is not None and repo_state.get('build_verdict_sha') == commit_sha:
+            logging.info(f"Repo {repo_name}: reusing build system verdict for {commit_sha[:7]}.")
+            return bool(repo_state['build_verdict'])
+        tree_sha = branch['commit']['commit']['tree']['sha']
+        tree = client.get_json(f"/repos/{full_name}/git/trees/{tree_sha}", {'recursive': '1'})
+    except (GitHubAPIError, KeyError, TypeError) as e:
+        logging.warning(f"Repo {repo_name}: could not list its files through the API ({e}). Checking it after cloning.")
+        return None
+    if tree.get('truncated'):
+        logging.info(f"Repo {repo_name}: the API listing of its files is truncated. Checking it after cloning.")
+        return None
+
+    found_build_files = build_files_in_paths(entry['path'] for entry in tree.get('tree', []) if entry.get('type') == 'blob')
+    qualifies = evaluate_build_files(found_build_files, repo_name)
+    record_repo_state(state_store, repo_name, build_verdict=int(qualifies), build_verdict_sha=commit_sha,
+                      build_verdict_pushed_at=repo_detail.get('pushed_at'))
+    return qualifies
+
+
+# Run the pre-clone check for all repositories with api_workers concurrent requests.
+# Returns the repositories still to clone (qualifying or undecided, in the given order) and the
+# names of the rejected ones.
+def precheck_build_systems(client, repos_with_details, state_store=None, api_workers=4):
+    with ThreadPoolExecutor(max_workers=max(1, api_workers)) as executor:
+        verdicts = list(executor.map(lambda repo_detail: remote_build_verdict(client, repo_detail, state_store),
+                                     repos_with_details))
+    repos_to_clone = [repo_detail for repo_detail, verdict in zip(repos_with_details, verdicts) if verdict is not False]
+    rejected_repos = [repo_detail['name'] for repo_detail, verdict in zip(repos_with_details, verdicts) if verdict is False]
+    for repo_name in rejected_repos:
+        record_repo_state(state_store, repo_name, stage='rejected')
+    undecided = sum(1 for verdict in verdicts if verdict is None)
+    logging.info(f"Build system pre-check: {len(repos_to_clone) - undecided} qualifying, {len(rejected_repos)} rejected "
+                 f"without cloning, {undecided} undecided (checked after cloning).")
+    if rejected_repos:
+        logging.info(f"Repos rejected by the build system pre-check: {rejected_repos}")
+    return repos_to_clone, rejected_repos
+
+
+def disk_usage_exceeded(download_folder_base, log_usage=True):
+    # Check usage of the base download folder
+    total, used, free = shutil.disk_usage(download_folder_base)
+    used_percentage = (used / total) * 100
+    if log_usage:
+        logging.info(f"Disk usage of {download_folder_base}: {used_percentage:.2f}%")
+    if used_percentage > DISK_USAGE_LIMIT_PERCENT:
+        logging.warning(f"Disk usage exceeded {DISK_USAGE_LIMIT_PERCENT}% ({used_percentage:.2f}% used). Stopping the cloning process.")
+        return True
+    return False
+
+
+# Size in bytes of the objects git stores for a repository (loose objects and packs)
+def git_object_bytes(repo_path):
+    sizes = {}
+    for line in run_git(repo_path, 'count-objects', '-v').splitlines():
+        key, _, value = line.partition(':')
+        sizes[key.strip()] = value.strip()
+    return (int(sizes.get('size', 0)) + int(sizes.get('size-pack', 0))) * 1024
+
+
+# --disk-budget: instead of polling the disk after each clone and stopping the whole run at
+# DISK_USAGE_LIMIT_PERCENT, the space of every clone is reserved before it starts. The size of a
+# clone is estimated from the size the search API reports for the repository (in KB, roughly its
+# packed history) times DISK_ESTIMATE_FACTOR for the checkout. Once a repository is cloned and
+# checked its reservation is replaced by the space it really takes, including what its
+# --mirror-cache mirror grew by; rejected clones are deleted first, so they give the space of
+# their checkout back (the mirror stays). A repository that does not fit waits for the clones in
+# flight to settle, and is only skipped ("over budget") once none are left. The run then goes
+# on with the next one, so a smaller repository can still fit.
+DISK_ESTIMATE_FACTOR = 2
+CLONE_PRIORITIES = ('stars', 'recency')
+_SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+# Parse a size like 500M, 20G or 1.5T (binary units) into bytes; used as an argparse type
+def parse_size(text):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*', text.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size {text!r}; use a number with an optional K, M, G or T suffix")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def format_size(size_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size_bytes) < 1024:
+            return f"{size_bytes:.1f} {unit}" if unit != 'B' else f"{size_bytes} B"
+        size_bytes /= 1024
+    return f"{size_bytes:.1f} TB"
+
+
+def estimated_clone_bytes(repo_detail):
+    return max(0, int(repo_detail.get('size') or 0)) * 1024 * DISK_ESTIMATE_FACTOR
+
+
+# Bytes taken by the files below path (checkout and .git)
+def directory_bytes(path):
+    total = 0
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.lstat(os.path.join(directory, file_name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class DiskBudget:
+    def __init__(self, download_folder_base, budget_bytes):
+        # Never plan past the usage limit of the volume, whatever the budget says
+        total, used, _ = shutil.disk_usage(download_folder_base)
+        headroom = max(0, int(total * DISK_USAGE_LIMIT_PERCENT / 100) - used)
+        self.capacity = min(budget_bytes, headroom)
+        if self.capacity < budget_bytes:
+            logging.warning(f"Disk budget of {format_size(budget_bytes)} capped to the {format_size(headroom)} left "
+                            f"before {download_folder_base} is {DISK_USAGE_LIMIT_PERCENT}% full.")
+        self.used = 0
+        self.over_budget = []
+        self._reserved = {}
+        # Reservations still holding their estimate, i.e. clones in flight
+        self._unsettled = set()
+        self._changed = threading.Condition()
+
+    # Reserve the space for a clone; False if it does not fit into what is left. While other
+    # clones are in flight, their estimates may shrink to what they really take (or be given
+    # back if they are rejected), so wait for them before giving up on the repo.
+    def reserve(self, repo_name, size_bytes):
+        with self._changed:
+            while self.used + size_bytes > self.capacity:
+                if not self._unsettled:
+                    self.over_budget.append(repo_name)
+                    logging.info(f"Repo {repo_name} (about {format_size(size_bytes)}) does not fit into the "
+                                 f"{format_size(self.capacity - self.used)} left of the disk budget. Skipping it.")
+                    return False
+                self._changed.wait()
+            self._reserved[repo_name] = size_bytes
+            self._unsettled.add(repo_name)
+            self.used += size_bytes
+            return True
+
+    # Replace the estimate with the space the clone really takes. A --shared clone does not
+    # hold the objects it borrows, so the growth of its mirror is passed as mirror_bytes; it
+    # stays charged when the clone is released, since the mirror is kept.
+    def settle(self, repo_name, repo_path, mirror_bytes=0):
+        actual = directory_bytes(repo_path) if os.path.isdir(repo_path) else 0
+        with self._changed:
+            if repo_name in self._reserved:
+                self.used += actual + mirror_bytes - self._reserved[repo_name]
+                self._reserved[repo_name] = actual
+            self._unsettled.discard(repo_name)
+            self._changed.notify_all()
+
+
+# Order the repositories by --clone-priority, so the most wanted ones are cloned (and take their
+# share of the budget) first, and log how many are expected to fit. Repositories that are
+# already cloned take no new space.
+def plan_disk_budget(repos_with_details, org_projects_dir, disk_budget, priority='stars'):
+    if priority == 'recency':
+        key = lambda repo_detail: repo_detail.get('pushed_at') or ''
+    else:
+        key = lambda repo_detail: (repo_detail.get('stargazers_count') or 0, repo_detail.get('pushed_at') or '')
+    planned_repos = sorted(repos_with_details, key=key, reverse=True)
+    expected_bytes = 0
+    expected_to_fit = 0
+    for repo_detail in planned_repos:
+        if os.path.exists(os.path.join(org_projects_dir, repo_detail['name'])):
+            expected_to_fit += 1
+            continue
+        estimate = estimated_clone_bytes(repo_detail)
+        if expected_bytes + estimate <= disk_budget.capacity:
+            expected_bytes += estimate
+            expected_to_fit += 1
+    logging.info(f"Disk budget: {format_size(disk_budget.capacity)}. About {expected_to_fit} of {len(planned_repos)} "
+                 f"repositories ({format_size(expected_bytes)} estimated) fit; they are cloned in order of {priority}.")
+    return planned_repos
+
+
+# Clone a single repository and check its build system.
+# Returns one of "kept", "excluded", "rejected", "failed", "skipped" ("skipped" means the
+# clone was never attempted because the disk usage limit was reached) or "over_budget" (the
+# clone did not fit into the --disk-budget).
+@profiled
+def clone_and_check_repo(repo_detail, org_projects_dir, download_folder_base, perform_build_check, stop_event,
+                         update_existing=False, clone_mode='full', state_store=None, metrics=None, mirror_cache_dir=None,
+                         disk_budget=None, fetch_all_objects=False):
+    repo_name = repo_detail['name']
+    repo_path_in_org_dir = os.path.join(org_projects_dir, repo_name)
+    repo_metrics = {}
+    outcome = "failed"
+    try:
+        outcome = _clone_and_check_repo(repo_detail, repo_path_in_org_dir, download_folder_base, perform_build_check,
+                                        stop_event, update_existing, clone_mode, state_store, repo_metrics,
+                                        mirror_cache_dir, disk_budget, fetch_all_objects)
+        return outcome
+    finally:
+        # Measured after the build check, so the deferred checkout of partial clones is included
+        if 'clone_seconds' in repo_metrics and os.path.isdir(repo_path_in_org_dir):
+            try:
+                repo_metrics['bytes'] = git_object_bytes(repo_path_in_org_dir)
+            except (subprocess.CalledProcessError, OSError, ValueError):
+                pass
+        if disk_budget is not None:
+            # Unwanted clones are deleted before settling, so reservations waiting for space
+            # see it freed as soon as this worker is done with the repo
+            if outcome in ("rejected", "failed") and os.path.exists(repo_path_in_org_dir):
+                remove_rejected_clones([repo_path_in_org_dir])
+            disk_budget.settle(repo_name, repo_path_in_org_dir, repo_metrics.get('mirror_bytes', 0))
+        record_repo_metrics(metrics, 'clone', repo_name, outcome=outcome, **repo_metrics)
+
+
+# Does the work of clone_and_check_repo and fills repo_metrics with the timings and clone size
+def _clone_and_check_repo(repo_detail, repo_path_in_org_dir, download_folder_base, perform_build_check, stop_event,
+                          update_existing, clone_mode, state_store, repo_metrics, mirror_cache_dir=None, disk_budget=None,
+                          fetch_all_objects=False):
+    repo_name = repo_detail['name']
+    repo_clone_url = repo_detail['clone_url']
+    repo_state = state_store.get(repo_name) if state_store is not None else None
+
+    try:
+        if (os.path.exists(repo_path_in_org_dir) and state_store is not None
+                and state_store.stage(repo_name) == 'cloning'):
+            # The previous run crashed or stopped in the middle of this clone
+            logging.warning(f"Repo {repo_name} was only partially cloned by an earlier run. Cloning it again.")
+            shutil.rmtree(repo_path_in_org_dir)
+
+        if os.path.exists(repo_path_in_org_dir):
+            logging.info(f"Repo {repo_name} already exists. Verifying criteria...")
+            if update_existing:
+                # Fetch new commits for incremental exports; a stale clone is still usable
+                if mirror_cache_dir and os.path.exists(os.path.join(repo_path_in_org_dir, '.git', 'objects', 'info', 'alternates')):
+                    # The clone's fetch then finds the new objects in the mirror it borrows from
+                    try:
+                        update_repo_mirror(repo_detail, mirror_cache_dir, repo_metrics)
+                    except (subprocess.CalledProcessError, OSError) as e:
+                        logging.warning(f"Repo {repo_name}: could not update its mirror. Reason: {e}")
+                try:
+                    update_existing_clone(repo_path_in_org_dir, repo_name)
+                except subprocess.CalledProcessError as e:
+                    logging.warning(f"Failed to update existing repo {repo_name}. Reason: {e.stderr}")
+            head_sha = current_head_sha(repo_path_in_org_dir)
+            # If build check is active, we need to re-verify it for existing repos too.
+            if perform_build_check:
+                check_start = time.time()
+                qualifies = check_build_system_cached(repo_path_in_org_dir, repo_name, head_sha, repo_detail, repo_state, state_store)
+                repo_metrics['check_seconds'] = round(time.time() - check_start, 3)
+                if not qualifies:
+                    logging.warning(f"Repo {repo_name} (existing) does not meet build system criteria. Excluding from this run.")
+                    record_repo_state(state_store, repo_name, stage='rejected', head_sha=head_sha)
+                    # Unlike newly cloned ones, we don't typically delete pre-existing ones that fail a check unless specified.
+                    return "excluded"
+                logging.info(f"Repo {repo_name} (existing) meets build criteria.")
+            else:
+                # Build check is not active, so if it exists and matches other criteria, it's good.
+                logging.info(f"Repo {repo_name} (existing) kept as build system check is not active.")
+            if fetch_all_objects:
+                # A partial clone made by a run without --export-git-log
+                try:
+                    fetch_missing_objects(repo_path_in_org_dir, repo_name)
+                except subprocess.CalledProcessError as e:
+                    logging.warning(f"Repo {repo_name}: could not fetch its missing objects; the export fetches them on demand. Reason: {e.stderr}")
+            record_repo_state(state_store, repo_name, stage='checked', head_sha=head_sha, error=None)
+            return "kept"
+
+        # A repo rejected earlier and not pushed to since still has the same HEAD: don't clone it again
+        if (perform_build_check and repo_state and repo_state.get('build_verdict') == 0
+                and repo_detail.get('pushed_at') and repo_state.get('build_verdict_pushed_at') == repo_detail.get('pushed_at')):
+            logging.info(f"Repo {repo_name} failed the build system check at {(repo_state['build_verdict_sha'] or '')[:7]} "
+                         f"and has not been pushed to since. Skipping clone.")
+            return "excluded"
+
+        # Another worker may have hit the disk usage limit while this repo was queued
+        if stop_event.is_set():
+            return "skipped"
+        # With several clones in flight the volume can fill up between post-clone checks, so
+        # look at the disk again right before starting a new clone. With --disk-budget this is
+        # the backstop for space the budget does not see (other processes, low estimates).
+        with _disk_check_lock:
+            if stop_event.is_set() or disk_usage_exceeded(download_folder_base, log_usage=False):
+                stop_event.set()
+                return "skipped"
+        # Reserved up front, so concurrent clones can never overrun the budget together
+        if disk_budget is not None and not disk_budget.reserve(repo_name, estimated_clone_bytes(repo_detail)):
+            return "over_budget"
+
+        mirror_dir = None
+        if mirror_cache_dir:
+            try:
+                mirror_dir = update_repo_mirror(repo_detail, mirror_cache_dir, repo_metrics)
+            except (subprocess.CalledProcessError, OSError) as e:
+                reason = e.stderr.strip() if isinstance(e, subprocess.CalledProcessError) and e.stderr else e
+                logging.warning(f"Repo {repo_name}: could not update its mirror. Cloning without it. Reason: {reason}")
+
+        if mirror_dir:
+            # A local clone that borrows the mirror's objects; --clone-mode filters do not apply
+            clone_source = mirror_dir
+            clone_options = ['--shared']
+            defer_checkout = perform_build_check
+        else:
+            clone_source = repo_clone_url
+            clone_options = list(CLONE_MODE_OPTIONS[clone_mode])
+            # Partial clones skip the checkout until the build check passed, so rejected repos
+            # never download any file contents
+            defer_checkout = clone_mode != 'full' and perform_build_check
+        if defer_checkout:
+            clone_options.append('--no-checkout')
+        if mirror_dir:
+            logging.info(f"Cloning {repo_name} from its mirror {mirror_dir}...")
+        else:
+            logging.info(f"Cloning {repo_name} from {repo_clone_url}{f' ({clone_mode} clone)' if clone_mode != 'full' else ''}...")
+        record_repo_state(state_store, repo_name, stage='cloning', error=None)
+        clone_start = time.time()
+        Repo.clone_from(clone_source, repo_path_in_org_dir, multi_options=clone_options)
+        if mirror_dir:
+            # Later fetches (--incremental) go to the repository itself, not to the mirror
+            run_git(repo_path_in_org_dir, 'remote', 'set-url', 'origin', repo_clone_url)
+        repo_metrics['clone_seconds'] = round(time.time() - clone_start, 3)
+        head_sha = current_head_sha(repo_path_in_org_dir)
+        record_repo_state(state_store, repo_name, stage='cloned', head_sha=head_sha, clone_seconds=repo_metrics['clone_seconds'])
+        logging.info(f"Successfully cloned {repo_name} to {repo_path_in_org_dir}")
+
+        # Perform build system check only if applicable
+        if perform_build_check:
+            check_start = time.time()
+            qualifies = check_build_system_cached(repo_path_in_org_dir, repo_name, head_sha, repo_detail, repo_state, state_store)
+            repo_metrics['check_seconds'] = round(time.time() - check_start, 3)
+            if not qualifies:
+                # Build system check failed for a Java project, schedule for deletion
+                record_repo_state(state_store, repo_name, stage='rejected')
+                return "rejected"
+        else:
+            # Build system check is not active (either non-Java lang or explicitly disabled for Java)
+            logging.info(f"Repo {repo_name} kept as build system check is not active.")
+        if fetch_all_objects and not mirror_dir and clone_mode != 'full':
+            # Before the deferred checkout, which then finds its blobs locally as well
+            refetch_start = time.time()
+            try:
+                fetch_missing_objects(repo_path_in_org_dir, repo_name)
+            except subprocess.CalledProcessError as e:
+                logging.warning(f"Repo {repo_name}: could not fetch its missing objects; the export fetches them on demand. Reason: {e.stderr}")
+            repo_metrics['refetch_seconds'] = round(time.time() - refetch_start, 3)
+        if defer_checkout:
+            run_git(repo_path_in_org_dir, 'reset', '--hard', '--quiet', 'HEAD')
+        record_repo_state(state_store, repo_name, stage='checked')
+
+        # Disk usage check only for successfully qualified and cloned repos
+        if disk_budget is None:
+            with _disk_check_lock:
+                if disk_usage_exceeded(download_folder_base):
+                    stop_event.set()
+        return "kept"
+
+    except Exception as e:
+        logging.warning(f"Failed to clone or process {repo_name}. Reason: {e}")
+        record_repo_state(state_store, repo_name, stage='failed', error=str(e))
+        return "failed"
+
+
+def clone_repositories(repos_with_details, org_projects_dir, download_folder_base, perform_build_check, clone_workers=1,
+                       update_existing=False, clone_mode='full', state_store=None, metrics=None, mirror_cache_dir=None,
+                       disk_budget=None, fetch_all_objects=False):
     # Filtered list of repo names that meet all criteria including build system
     final_repos_to_process = []
-    
     # Temporarily store repos that are cloned but fail build check, to be deleted
     repos_to_delete_after_check = []
+    # Repos that failed to clone for other reasons
+    failed_clones = []
 
-    # Function to check build system
-    def check_build_system(repo_clone_path, repo_name_for_log):
-        # Traverse the directory tree to find build files
-        found_maven = False
-        found_gradle = False
-        found_ant = False
-        found_bazel = False
-
-        for root, dirs, files in os.walk(repo_clone_path):
-            # Skip .git directory to avoid issues and speed up search
-            if ".git" in dirs:
-                dirs.remove(".git")
-            
-            if "pom.xml" in files:
-                found_maven = True
-            if "build.gradle" in files or "build.gradle.kts" in files:
-                found_gradle = True
-            if "build.xml" in files:
-                found_ant = True
-            if "WORKSPACE" in files or "BUILD" in files or "BUILD.bazel" in files:
-                found_bazel = True
-        
-        # Decision logic based on found files
-        if (found_maven or found_gradle) and not (found_ant or found_bazel):
-            build_system = []
-            if found_maven:
-                build_system.append("Maven")
-            if found_gradle:
-                build_system.append("Gradle")
-            logging.info(f"Repo {repo_name_for_log}: Found {' and '.join(build_system)}. Qualifying build system.")
-            return True
-        else:
-            reasons = []
-            if not (found_maven or found_gradle):
-                reasons.append("Neither Maven nor Gradle found anywhere in the project")
-            if found_ant:
-                reasons.append("Ant build file (build.xml) detected")
-            if found_bazel:
-                reasons.append("Bazel build file (WORKSPACE, BUILD, or BUILD.bazel) detected")
-            
-            # More specific logging if both desired and undesired systems are found
-            if (found_maven or found_gradle) and (found_ant or found_bazel):
-                 reasons.append("Project contains a mix of desired (Maven/Gradle) and undesired (Ant/Bazel) build systems.")
-
-            logging.warning(f"Repo {repo_name_for_log}: Build system check failed. Reasons: {'; '.join(reasons)}. Excluding.")
-            return False
-
-    logging.info("=== Cloning repositories and checking build systems ===")
-    failed_clones = [] # Repos that failed to clone for other reasons
-
-    for repo_detail in repos_with_details:
+    # Set by any worker once the disk usage limit is reached; queued clones are then skipped
+    stop_event = threading.Event()
+    outcomes = {}
+    progress = ProgressTracker("Cloning", len(repos_with_details))
+
+    with ThreadPoolExecutor(max_workers=max(1, clone_workers)) as executor:
+        futures = {
+            executor.submit(clone_and_check_repo, repo_detail, org_projects_dir, download_folder_base,
+                            perform_build_check, stop_event, update_existing, clone_mode, state_store, metrics,
+                            mirror_cache_dir, disk_budget, fetch_all_objects): index
+            for index, repo_detail in enumerate(repos_with_details)
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            # Under a disk budget, the worker already deleted unwanted clones so their space can be reused
+            outcomes[index] = future.result()
+            progress.advance(repos_with_details[index]['name'])
+
+    # Collect the results in API order so the output does not depend on completion order
+    skipped_for_disk_space = []
+    for index, repo_detail in enumerate(repos_with_details):
         repo_name = repo_detail['name']
-        repo_clone_url = repo_detail['clone_url']
         repo_path_in_org_dir = os.path.join(org_projects_dir, repo_name)
+        outcome = outcomes[index]
+        if outcome == "kept":
+            final_repos_to_process.append(repo_name)
+        elif outcome == "rejected" and os.path.exists(repo_path_in_org_dir):
+            repos_to_delete_after_check.append(repo_path_in_org_dir)
+        elif outcome == "failed":
+            failed_clones.append(repo_name)
+            # If cloning failed, the path might not exist or be partial.
+            # Ensure we don't try to delete a non-existent/problematic path.
+            if os.path.exists(repo_path_in_org_dir) and repo_path_in_org_dir not in repos_to_delete_after_check:
+                repos_to_delete_after_check.append(repo_path_in_org_dir)
+        elif outcome == "skipped":
+            skipped_for_disk_space.append(repo_name)
+
+    if skipped_for_disk_space:
+        failed_clones.extend(skipped_for_disk_space)
+        logging.info(f"The following repos were not attempted due to disk space: {skipped_for_disk_space}")
 
+    return final_repos_to_process, repos_to_delete_after_check, failed_clones
+
+
+def remove_rejected_clones(repo_paths):
+    for repo_path_to_delete in repo_paths:
         try:
-            if os.path.exists(repo_path_in_org_dir):
-                logging.info(f"Repo {repo_name} already exists. Verifying criteria...")
-                # If build check is active, we need to re-verify it for existing repos too.
-                if perform_build_check:
-                    if check_build_system(repo_path_in_org_dir, repo_name):
-                        final_repos_to_process.append(repo_name)
-                        logging.info(f"Repo {repo_name} (existing) meets build criteria.")
-                    else:
-                        logging.warning(f"Repo {repo_name} (existing) does not meet build system criteria. Excluding from this run.")
-                        # Unlike newly cloned ones, we don't typically delete pre-existing ones that fail a check unless specified.
-                else:
-                    # Build check is not active, so if it exists and matches other criteria, it's good.
-                    final_repos_to_process.append(repo_name)
-                    logging.info(f"Repo {repo_name} (existing) kept as build system check is not active.")
-                continue
+            shutil.rmtree(repo_path_to_delete)
+            logging.info(f"Successfully deleted {repo_path_to_delete}")
+        except Exception as e:
+            logging.error(f"Failed to delete directory {repo_path_to_delete}. Reason: {e}")
 
-            logging.info(f"Cloning {repo_name} from {repo_clone_url}...")
-            Repo.clone_from(repo_clone_url, repo_path_in_org_dir)
-            logging.info(f"Successfully cloned {repo_name} to {repo_path_in_org_dir}")
+GIT_LOG_COLUMNS = ["Commit Hash", "Date", "Author Name", "Author Email", "Added Lines", "Deleted Lines", "File Path"]
 
-            # Perform build system check only if applicable
-            if perform_build_check:
-                if check_build_system(repo_path_in_org_dir, repo_name):
-                    final_repos_to_process.append(repo_name)
-                    # Disk usage check only for successfully qualified and cloned repos
-                    total, used, free = shutil.disk_usage(download_folder_base) # Check usage of the base download folder
-                    used_percentage = (used / total) * 100
-                    logging.info(f"Disk usage of {download_folder_base}: {used_percentage:.2f}%")
-                    if used_percentage > 90:
-                        logging.warning(f"Disk usage exceeded 90% ({used_percentage:.2f}% used). Stopping the cloning process.")
-                        current_index = repos_with_details.index(repo_detail)
-                        remaining_api_repos = [r['name'] for r in repos_with_details[current_index+1:]]
-                        failed_clones.extend(remaining_api_repos) 
-                        logging.info(f"The following repos were not attempted due to disk space: {remaining_api_repos}")
-                        break 
-                else:
-                    # Build system check failed for a Java project, schedule for deletion
-                    repos_to_delete_after_check.append(repo_path_in_org_dir)
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+# Test files as counted by the c4t (commit for test) analysis, per --language (lowercase).
+# A path is a test file if any rule of its language is found in it. Languages without rules
+# use the Java rules, which were the only rules before.
+JS_TEST_FILE_RULES = [r'\.(test|spec)\.[cm]?[jt]sx?$', r'(^|/)__tests__/.*\.[cm]?[jt]sx?$']
+TEST_FILE_RULES = {
+    'java': [r'src/test/.*Test.*\.java'],
+    'kotlin': [r'src/test/.*Test.*\.kt'],
+    'python': [r'(^|/)test_[^/]*\.py$', r'_test\.py$', r'(^|/)tests?/.*\.py$'],
+    'go': [r'_test\.go$'],
+    'javascript': JS_TEST_FILE_RULES,
+    'typescript': JS_TEST_FILE_RULES,
+}
+TEST_FILE_RULE_ALIASES = {'js': 'javascript', 'ts': 'typescript', 'golang': 'go'}
+
+
+# Decides which changed files are test files. File paths repeat across most commits of a
+# repository, so every distinct path is matched against the rules once and the answer is
+# remembered; use one classifier per repository to keep the memo small.
+class TestFileClassifier:
+    def __init__(self, language='Java'):
+        language = language.lower()
+        self.language = TEST_FILE_RULE_ALIASES.get(language, language)
+        if self.language not in TEST_FILE_RULES:
+            self.language = 'java'
+        self.pattern = re.compile('|'.join(f'(?:{rule})' for rule in TEST_FILE_RULES[self.language]))
+        self._verdicts = {}
+
+    def is_test_file(self, path):
+        try:
+            return self._verdicts[path]
+        except KeyError:
+            verdict = self._verdicts[path] = self.pattern.search(path) is not None
+            return verdict
+
+    # Boolean mask over a pandas Series of paths: the distinct paths are classified and the
+    # verdicts are spread back over the rows by their factorized codes (-1, i.e. missing
+    # values, picks the trailing False)
+    def test_file_mask(self, paths):
+        codes, unique_paths = pd.factorize(paths)
+        verdicts = pd.Series([self.is_test_file(path) for path in unique_paths] + [False], dtype=bool).to_numpy()
+        return pd.Series(verdicts[codes], index=paths.index)
+
+    # The same for a dictionary-encoded pyarrow column, whose dictionaries already hold the
+    # distinct paths and whose indices are the codes
+    def arrow_test_file_mask(self, paths):
+        masks = []
+        for chunk in paths.chunks:
+            verdicts = pa.array([path is not None and self.is_test_file(path) for path in chunk.dictionary.to_pylist()],
+                                pa.bool_())
+            masks.append(pc.fill_null(pc.take(verdicts, chunk.indices), False))
+        return pa.chunked_array(masks, pa.bool_())
+
+
+# Commit logs are written as CSV or, with --output-format parquet, as compressed Parquet with
+# dictionary-encoded string columns and integer line counts
+OUTPUT_FORMATS = ('csv', 'parquet')
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_ROW_GROUP_ROWS = 100000
+COUNT_COLUMNS = ("Added Lines", "Deleted Lines")
+
+
+def commit_log_schema(columns=GIT_LOG_COLUMNS):
+    return pa.schema([(column, pa.int64() if column in COUNT_COLUMNS else pa.dictionary(pa.int32(), pa.string()))
+                      for column in columns])
+
+
+def git_log_path(target_log_dir, repo_name, output_format='csv'):
+    return os.path.join(target_log_dir, f"{repo_name}_git_log.{output_format}")
+
+
+def test_log_path(c4t_dir, repo_name, output_format='csv'):
+    return os.path.join(c4t_dir, f"{repo_name}_test_commit_log.{output_format}")
+
+
+def merged_test_log_path(c4t_dir, output_format='csv'):
+    return os.path.join(c4t_dir, f"all_test_commit_log.{output_format}")
+
+
+# Project name of a *_git_log.<format> or *_test_commit_log.<format> file
+def log_project_name(log_file):
+    name = os.path.splitext(os.path.basename(log_file))[0]
+    for suffix in ("_git_log", "_test_commit_log"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+# Base of the commit log writers, which provide writerow(), close() and abort(). Used as a
+# context manager, a writer is closed when the block succeeds and aborted when it raises.
+class CommitLogWriter:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Writes commit log rows (lists of strings as yielded by iter_git_log_rows) to a CSV file.
+# With append=True rows are added to an existing file, and the header is only written to a new one.
+class CsvCommitLogWriter(CommitLogWriter):
+    def __init__(self, path, append=False, lineterminator='\r\n'):
+        write_header = not (append and os.path.exists(path))
+        self._file = open(path, mode='a' if append else 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file, lineterminator=lineterminator)
+        if write_header:
+            self._writer.writerow(GIT_LOG_COLUMNS)
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+    # Appended CSV rows stay; incremental exports cut them off using the recorded file size
+    def abort(self):
+        self._file.close()
+
+
+# Writes commit log rows to a Parquet file in row groups of PARQUET_ROW_GROUP_ROWS rows.
+# Parquet files cannot be appended to, so with append=True the row groups of the existing file
+# (if any) are streamed into a .partial file that replaces it on close(); abort() removes the
+# .partial file and leaves the old one untouched.
+class ParquetCommitLogWriter(CommitLogWriter):
+    def __init__(self, path, append=False, lineterminator=None):
+        self.path = path
+        self._append = append
+        self._write_path = path + ".partial" if append else path
+        self._schema = commit_log_schema()
+        self._writer = pq.ParquetWriter(self._write_path, self._schema, compression=PARQUET_COMPRESSION)
+        self._columns = [[] for _ in GIT_LOG_COLUMNS]
+        if append and os.path.exists(path):
+            existing = pq.ParquetFile(path)
+            for row_group in range(existing.num_row_groups):
+                self._writer.write_table(existing.read_row_group(row_group).cast(self._schema))
+
+    def writerow(self, row):
+        for values, value in zip(self._columns, row):
+            values.append(value)
+        if len(self._columns[0]) >= PARQUET_ROW_GROUP_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if not self._columns[0]:
+            return
+        arrays = []
+        for column, values in zip(GIT_LOG_COLUMNS, self._columns):
+            if column in COUNT_COLUMNS:
+                arrays.append(pa.array([int(value) for value in values], pa.int64()))
             else:
-                # Build system check is not active (either non-Java lang or explicitly disabled for Java)
-                final_repos_to_process.append(repo_name)
-                logging.info(f"Repo {repo_name} kept as build system check is not active.")
-                # Disk usage check also applies here if repo is kept
-                total, used, free = shutil.disk_usage(download_folder_base) 
-                used_percentage = (used / total) * 100
-                logging.info(f"Disk usage of {download_folder_base}: {used_percentage:.2f}%")
-                if used_percentage > 90:
-                    logging.warning(f"Disk usage exceeded 90% ({used_percentage:.2f}% used). Stopping the cloning process.")
-                    current_index = repos_with_details.index(repo_detail)
-                    remaining_api_repos = [r['name'] for r in repos_with_details[current_index+1:]]
-                    failed_clones.extend(remaining_api_repos) 
-                    logging.info(f"The following repos were not attempted due to disk space: {remaining_api_repos}")
-                    break 
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self._columns = [[] for _ in GIT_LOG_COLUMNS]
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        if self._append:
+            os.replace(self._write_path, self.path)
+
+    def abort(self):
+        self._writer.close()
+        if self._append and os.path.exists(self._write_path):
+            os.remove(self._write_path)
+
+
+def open_commit_log_writer(path, output_format='csv', append=False, lineterminator='\r\n'):
+    writer_class = ParquetCommitLogWriter if output_format == 'parquet' else CsvCommitLogWriter
+    return writer_class(path, append=append, lineterminator=lineterminator)
+
+
+# Parse `git log --numstat --pretty=format:%H,%ad,%aN,%ae` output line by line and
+# yield one row per changed file. Works on any iterable of lines, so the output can be
+# consumed straight from git's stdout without holding the whole log in memory.
+def iter_git_log_rows(lines):
+    current_commit_info = [] # Renamed from commit_info
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip(): # Skip empty lines that might occur between commit blocks
+            continue
+
+        # Check if the line is a commit metadata line (Hash,Date,Author,Email)
+        # It expects 4 comma-separated values.
+        parts = line.split(',', 3)
+        if len(parts) == 4 and len(parts[0]) == 40 and _HEX_DIGITS.issuperset(parts[0]): # Heuristic for commit hash
+            current_commit_info = parts
+        elif current_commit_info and '\t' in line:  # Assumed numstat line associated with current_commit_info
+            stats = line.split('\t')
+            if len(stats) == 3:  # Added, Deleted, Path
+                # Handle cases where added/deleted might be '-'
+                added = stats[0] if stats[0] != '-' else '0'
+                deleted = stats[1] if stats[1] != '-' else '0'
+                yield current_commit_info + [added, deleted, stats[2]]
+
+
+# Run `git log --numstat` for a repository and yield its rows while git is still writing.
+# revision can be a commit or a range such as "<last>..<head>"; defaults to HEAD.
+# Raises subprocess.CalledProcessError once the output is consumed if git exits with an error.
+def stream_git_log_rows(repo_full_path, revision=None):
+    # Ensure git commands run from within the repo's directory or use -C
+    # Using -C is safer
+    git_command = [
+        'git', '-C', repo_full_path, 'log',
+        '--date=short',
+        '--numstat',
+        '--pretty=format:%H,%ad,%aN,%ae' # Removed "commit " prefix from here
+    ]
+    if revision:
+        git_command += [revision, '--']
+
+    # stderr goes to a temporary file so a chatty git can never block on a full pipe
+    # while we are still reading stdout.
+    with tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(git_command, stdout=subprocess.PIPE, stderr=stderr_file,
+                                   text=True, encoding='utf-8', errors='replace')
+        try:
+            yield from iter_git_log_rows(process.stdout)
+        finally:
+            # Stop git if the consumer bailed out early (e.g. a write error)
+            if process.poll() is None and not process.stdout.closed:
+                process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            stderr_file.seek(0)
+            stderr_text = stderr_file.read().decode('utf-8', errors='replace')
+            raise subprocess.CalledProcessError(returncode, git_command, stderr=stderr_text)
+
+
+# The export state of a repository records the last exported commit and the sizes of its log
+# files at that point (0 for a file that does not exist), so incremental exports know where to
+# continue and can cut off rows that an interrupted append left behind. test_log_filtered is
+# False while the test commit log has not been filtered from a newly exported full log yet.
+def export_state_path(target_log_dir, repo_name):
+    return os.path.join(target_log_dir, f"{repo_name}_export_state.json")
+
+
+def load_export_state(target_log_dir, repo_name):
+    try:
+        with open(export_state_path(target_log_dir, repo_name), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_export_state(target_log_dir, repo_name, last_commit, log_file_path=None, test_log_file_path=None,
+                      test_log_filtered=True):
+    state = {
+        'last_commit': last_commit,
+        'log_size': os.path.getsize(log_file_path) if log_file_path and os.path.exists(log_file_path) else 0,
+        'test_log_size': os.path.getsize(test_log_file_path) if test_log_file_path and os.path.exists(test_log_file_path) else 0,
+        'test_log_filtered': test_log_filtered,
+    }
+    state_path = export_state_path(target_log_dir, repo_name)
+    with open(state_path + ".partial", 'w', encoding='utf-8') as file:
+        json.dump(state, file)
+    os.replace(state_path + ".partial", state_path)
+    return state
+
+
+# Record that the test commit log was filtered from the full log of the exported commit.
+# Pass test_log_file_path=None when filtering found no test commits.
+def mark_test_log_filtered(target_log_dir, repo_name, log_file_path, test_log_file_path):
+    state = load_export_state(target_log_dir, repo_name)
+    if state and state.get('last_commit') and not state.get('test_log_filtered', True):
+        save_export_state(target_log_dir, repo_name, state['last_commit'], log_file_path, test_log_file_path)
+
+
+# Count the rows (changed files) and commits passing through an exporter into its stats dict
+def count_git_log_row(stats, row):
+    if stats is not None:
+        stats['rows'] = stats.get('rows', 0) + 1
+        if row[0] != stats.get('_last_commit'):
+            stats['_last_commit'] = row[0]
+            stats['commits'] = stats.get('commits', 0) + 1
+
+
+# Export the git log with the diff information as a CSV (or Parquet) file.
+# Returns True if the log was exported or already exists, False if the export failed.
+# The exporters and filter_test_commits add the rows, commits and test rows they parse to stats.
+def export_git_log_to_csv(repo_name, cloned_repos_container_dir, target_log_dir, stats=None, output_format='csv'):
+    # repo_path is the full path to the specific repo inside org_projects_dir
+    repo_full_path = os.path.join(cloned_repos_container_dir, repo_name)
+    log_file_path = git_log_path(target_log_dir, repo_name, output_format)
+    # Rows are streamed into a temporary file that only replaces the final one once git
+    # finished successfully, so an interrupted export never looks like a complete log.
+    partial_log_file_path = log_file_path + ".partial"
+
+    try:
+        # Check if log file already exists
+        if os.path.exists(log_file_path):
+            logging.info(f"Git log for {repo_name} already exists at {log_file_path}. Skipping export.")
+            return True
+
+        # Pin the exported commit so the export state matches exactly what was written
+        head_commit = run_git(repo_full_path, 'rev-parse', 'HEAD')
+        with open_commit_log_writer(partial_log_file_path, output_format) as writer:
+            for row in stream_git_log_rows(repo_full_path, head_commit):
+                writer.writerow(row)
+                count_git_log_row(stats, row)
+        os.replace(partial_log_file_path, log_file_path)
+        # The test commit log is only up to date with head_commit once the log is filtered
+        save_export_state(target_log_dir, repo_name, head_commit, log_file_path, test_log_filtered=False)
+
+        logging.info(f"Successfully exported git log for {repo_name} to {log_file_path}")
+        return True
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Failed to export git log for {repo_name}. Reason: {e.stdout} {e.stderr}")
+    except Exception as ex: # Catch other potential errors like file writing issues
+        logging.warning(f"An unexpected error occurred during git log export for {repo_name}. Reason: {ex}")
+    finally:
+        if os.path.exists(partial_log_file_path):
+            os.remove(partial_log_file_path)
+    return False
+
+
+# Export the git log and write the test commit log in the same pass: every numstat row is
+# classified while git's output is parsed, so the full log never has to be written and read
+# back. The full log is still written alongside when keep_full_log is set.
+# Returns "saved", "no_test_commits" or "failed", like filter_test_commits.
+def export_test_commits_single_pass(repo_name, cloned_repos_container_dir, target_log_dir, c4t_dir, keep_full_log=False,
+                                    stats=None, test_file_classifier=None, output_format='csv'):
+    repo_full_path = os.path.join(cloned_repos_container_dir, repo_name)
+    log_file_path = git_log_path(target_log_dir, repo_name, output_format)
+    test_log_file_path = test_log_path(c4t_dir, repo_name, output_format)
+    partial_log_file_path = log_file_path + ".partial"
+    partial_test_log_file_path = test_log_file_path + ".partial"
+
+    if os.path.exists(test_log_file_path) and (not keep_full_log or os.path.exists(log_file_path)):
+        logging.info(f"Test commit log for {repo_name} already exists at {test_log_file_path}. Skipping export.")
+        return "saved"
+
+    test_file_classifier = test_file_classifier or TestFileClassifier()
+    try:
+        head_commit = run_git(repo_full_path, 'rev-parse', 'HEAD')
+        test_rows = 0
+        with contextlib.ExitStack() as writers:
+            # Same line endings as the pandas-written test commit logs
+            test_writer = writers.enter_context(
+                open_commit_log_writer(partial_test_log_file_path, output_format, lineterminator='\n'))
+            log_writer = None
+            if keep_full_log:
+                log_writer = writers.enter_context(open_commit_log_writer(partial_log_file_path, output_format))
+            for row in stream_git_log_rows(repo_full_path, head_commit):
+                count_git_log_row(stats, row)
+                if log_writer is not None:
+                    log_writer.writerow(row)
+                if test_file_classifier.is_test_file(row[6]):
+                    test_writer.writerow(row)
+                    test_rows += 1
+        if keep_full_log:
+            os.replace(partial_log_file_path, log_file_path)
+            logging.info(f"Successfully exported git log for {repo_name} to {log_file_path}")
+        if stats is not None:
+            stats['test_rows'] = test_rows
+
+        if test_rows:
+            os.replace(partial_test_log_file_path, test_log_file_path)
+        save_export_state(target_log_dir, repo_name, head_commit,
+                          log_file_path if keep_full_log else None, test_log_file_path if test_rows else None)
+        if test_rows:
+            logging.info(f"Saved test commit log for {repo_name}")
+            return "saved"
+        logging.warning(f"No test-related commits found for {repo_name}")
+        return "no_test_commits"
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Failed to export git log for {repo_name}. Reason: {e.stdout} {e.stderr}")
+    except Exception as ex: # Catch other potential errors like file writing issues
+        logging.warning(f"An unexpected error occurred during git log export for {repo_name}. Reason: {ex}")
+    finally:
+        for partial_path in (partial_log_file_path, partial_test_log_file_path):
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+    return "failed"
+
+
+def remove_exported_logs(repo_name, target_log_dir, c4t_dir, output_format='csv'):
+    for path in (git_log_path(target_log_dir, repo_name, output_format),
+                 test_log_path(c4t_dir, repo_name, output_format),
+                 export_state_path(target_log_dir, repo_name)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Append the commits made since the last export to the full log (if there is one) and to the
+# test commit log. Returns the filter status like export_test_commits_single_pass, or None when
+# there is no usable previous export and the repository needs a full export instead.
+def export_git_log_incremental(repo_name, cloned_repos_container_dir, target_log_dir, c4t_dir, stats=None,
+                               test_file_classifier=None, output_format='csv'):
+    repo_full_path = os.path.join(cloned_repos_container_dir, repo_name)
+    log_file_path = git_log_path(target_log_dir, repo_name, output_format)
+    test_log_file_path = test_log_path(c4t_dir, repo_name, output_format)
+
+    state = load_export_state(target_log_dir, repo_name)
+    if state is None and output_format == 'csv':
+        # Logs exported before the state file existed were written newest first and never
+        # appended to, so their first row holds the last exported commit. For a test commit log
+        # that is the newest test commit; newer commits did not touch tests, so re-reading them
+        # adds nothing.
+        for path in (log_file_path, test_log_file_path):
+            if os.path.exists(path):
+                with open(path, newline='', encoding='utf-8') as file:
+                    reader = csv.reader(file)
+                    next(reader, None)
+                    first_row = next(reader, None)
+                if first_row:
+                    state = {'last_commit': first_row[0], 'log_size': None, 'test_log_size': None}
+                break
+    if not state or not state.get('last_commit'):
+        return None
+    # A log file the state refers to was removed since the last export: start over
+    for path, size in ((log_file_path, state.get('log_size')), (test_log_file_path, state.get('test_log_size'))):
+        if size and not os.path.exists(path):
+            logging.info(f"Git log files of {repo_name} changed since the last export. Re-exporting the full log.")
+            remove_exported_logs(repo_name, target_log_dir, c4t_dir, output_format)
+            return None
+
+    last_commit = state['last_commit']
+    test_file_classifier = test_file_classifier or TestFileClassifier()
+    try:
+        # The last run exported the full log but stopped before filtering it (states written
+        # before test_log_filtered existed only recorded the test log size once it was filtered):
+        # filter it now, so the test commit log covers everything up to last_commit.
+        test_log_filtered = state.get('test_log_filtered', state.get('test_log_size') is not None)
+        if not test_log_filtered and os.path.exists(log_file_path):
+            logging.info(f"Filtering the git log of {repo_name} exported by an interrupted run...")
+            filter_status = filter_test_commits(log_file_path, c4t_dir, None, test_file_classifier)
+            if filter_status == "failed":
+                return "failed"
+            state = save_export_state(target_log_dir, repo_name, last_commit, log_file_path,
+                                      test_log_file_path if filter_status == "saved" else None)
+
+        # Drop anything an interrupted run wrote after the recorded state. CSV files are cut back
+        # to their recorded size, and files that did not exist then are removed. Parquet files
+        # are replaced as a whole, so one that changed anyway is exported again in full.
+        for path, size in ((log_file_path, state.get('log_size')), (test_log_file_path, state.get('test_log_size'))):
+            if size is None or not os.path.exists(path) or os.path.getsize(path) == size:
+                continue
+            if size == 0:
+                os.remove(path)
+            elif output_format == 'csv' and os.path.getsize(path) > size:
+                with open(path, 'r+b') as file:
+                    file.truncate(size)
+            else:
+                logging.info(f"Git log files of {repo_name} changed since the last export. Re-exporting the full log.")
+                remove_exported_logs(repo_name, target_log_dir, c4t_dir, output_format)
+                return None
+
+        head_commit = run_git(repo_full_path, 'rev-parse', 'HEAD')
+        if head_commit == last_commit:
+            logging.info(f"Git log for {repo_name} is up to date at {head_commit[:7]}.")
+            return "saved" if os.path.exists(test_log_file_path) else "no_test_commits"
+        try:
+            run_git(repo_full_path, 'merge-base', '--is-ancestor', last_commit, head_commit)
+        except subprocess.CalledProcessError:
+            # The last exported commit is gone (force-push) or not an ancestor: start over
+            logging.warning(f"Last exported commit {last_commit[:7]} of {repo_name} is not in its history anymore. Re-exporting the full log.")
+            remove_exported_logs(repo_name, target_log_dir, c4t_dir, output_format)
+            return None
+
+        logging.info(f"Appending commits {last_commit[:7]}..{head_commit[:7]} to the git log of {repo_name}...")
+        has_full_log = os.path.exists(log_file_path)
+        new_rows = 0
+        test_rows = 0
+        with contextlib.ExitStack() as writers:
+            log_writer = None
+            if has_full_log:
+                log_writer = writers.enter_context(open_commit_log_writer(log_file_path, output_format, append=True))
+            test_writer = None
+            for row in stream_git_log_rows(repo_full_path, f"{last_commit}..{head_commit}"):
+                new_rows += 1
+                count_git_log_row(stats, row)
+                if log_writer is not None:
+                    log_writer.writerow(row)
+                if test_file_classifier.is_test_file(row[6]):
+                    if test_writer is None:
+                        # Same line endings as the pandas-written test commit logs
+                        test_writer = writers.enter_context(
+                            open_commit_log_writer(test_log_file_path, output_format, append=True, lineterminator='\n'))
+                    test_writer.writerow(row)
+                    test_rows += 1
+
+        save_export_state(target_log_dir, repo_name, head_commit,
+                          log_file_path if has_full_log else None, test_log_file_path)
+        if stats is not None:
+            stats['test_rows'] = test_rows
+        logging.info(f"Appended {new_rows} rows ({test_rows} test-related) to the git log of {repo_name}.")
+        if os.path.exists(test_log_file_path):
+            return "saved"
+        logging.warning(f"No test-related commits found for {repo_name}")
+        return "no_test_commits"
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Failed to export git log for {repo_name}. Reason: {e.stdout} {e.stderr}")
+    except Exception as ex: # Catch other potential errors like file writing issues
+        logging.warning(f"An unexpected error occurred during git log export for {repo_name}. Reason: {ex}")
+    return "failed"
+
+
+# Filter one exported git log down to the commits that touch test files.
+# Returns "saved", "no_test_commits" or "failed".
+def filter_test_commits(log_file, c4t_dir, stats=None, test_file_classifier=None):
+    if log_file.endswith(".parquet"):
+        return filter_test_commits_parquet(log_file, c4t_dir, stats, test_file_classifier)
+    project_name = log_project_name(log_file)
+    test_file_classifier = test_file_classifier or TestFileClassifier()
+    try:
+        df = pd.read_csv(log_file)
         
+        # Ensure 'File Path' column exists
+        if 'File Path' not in df.columns:
+            logging.warning(f"Skipping {project_name}: 'File Path' column missing in {log_file}.")
+            return "failed"
+
+        # Filter records to the test files of the language, classifying each distinct path once
+        # Make sure File Path is string type before classifying it
+        df['File Path'] = df['File Path'].astype(str)
+        filtered_df = df[test_file_classifier.test_file_mask(df['File Path'])]
+        if stats is not None:
+            stats['filtered_rows'] = len(df)
+            stats['test_rows'] = len(filtered_df)
+
+        if not filtered_df.empty:
+            filtered_df.to_csv(test_log_path(c4t_dir, project_name), index=False)
+            logging.info(f"Saved test commit log for {project_name}")
+            return "saved"
+        logging.warning(f"No test-related commits found for {project_name}")
+        return "no_test_commits"
+    except pd.errors.EmptyDataError:
+        logging.warning(f"Log file {log_file} for project {project_name} is empty or not valid CSV. Skipping.")
+    except Exception as e:
+        logging.error(f"Error processing log file {log_file} for {project_name}. Reason: {e}")
+    return "failed"
+
+
+# filter_test_commits for a Parquet log, read and filtered natively with pyarrow
+def filter_test_commits_parquet(log_file, c4t_dir, stats=None, test_file_classifier=None):
+    project_name = log_project_name(log_file)
+    test_file_classifier = test_file_classifier or TestFileClassifier()
+    test_log_file_path = test_log_path(c4t_dir, project_name, 'parquet')
+    try:
+        table = pq.read_table(log_file).cast(commit_log_schema())
+        filtered_table = table.filter(test_file_classifier.arrow_test_file_mask(table['File Path']))
+        if stats is not None:
+            stats['filtered_rows'] = table.num_rows
+            stats['test_rows'] = filtered_table.num_rows
+
+        if filtered_table.num_rows:
+            pq.write_table(filtered_table, test_log_file_path + ".partial", compression=PARQUET_COMPRESSION)
+            os.replace(test_log_file_path + ".partial", test_log_file_path)
+            logging.info(f"Saved test commit log for {project_name}")
+            return "saved"
+        logging.warning(f"No test-related commits found for {project_name}")
+        return "no_test_commits"
+    except Exception as e:
+        logging.error(f"Error processing log file {log_file} for {project_name}. Reason: {e}")
+    return "failed"
+
+
+# Export and filter the git log of a single repository. Runs in a worker process when
+# --log-workers is greater than 1, so it only takes and returns picklable values.
+# Pass repo_name=None to only (re-)filter an already exported log file.
+@profiled
+def process_repo_git_log(repo_name, log_file, org_projects_dir, git_log_export_dir, c4t_dir,
+                         single_pass=False, keep_full_log=False, incremental=False, language='Java',
+                         output_format='csv'):
+    result = {'repo': repo_name or log_project_name(log_file),
+              'exported': None, 'filter_status': None, 'error': None}
+    task_start = time.time()
+    stats = {}
+    test_file_classifier = TestFileClassifier(language)
+    try:
+        if incremental and repo_name is not None:
+            filter_status = export_git_log_incremental(repo_name, org_projects_dir, git_log_export_dir, c4t_dir, stats,
+                                                       test_file_classifier, output_format)
+            if filter_status is not None:
+                result['filter_status'] = filter_status
+                result['exported'] = filter_status != "failed"
+                if not result['exported']:
+                    result['error'] = "incremental git log export failed"
+                return result
+        # A full log exported by an earlier run is cheaper to filter than to export again
+        if single_pass and repo_name is not None and not os.path.exists(log_file):
+            logging.info(f"Exporting git log and test commits for {repo_name} in a single pass...")
+            result['filter_status'] = export_test_commits_single_pass(repo_name, org_projects_dir, git_log_export_dir,
+                                                                      c4t_dir, keep_full_log, stats, test_file_classifier,
+                                                                      output_format)
+            result['exported'] = result['filter_status'] != "failed"
+            if not result['exported']:
+                result['error'] = "git log export failed"
+            return result
+        if repo_name is not None:
+            logging.info(f"Exporting git log for {repo_name}...")
+            result['exported'] = export_git_log_to_csv(repo_name, org_projects_dir, git_log_export_dir, stats, output_format)
+            if not result['exported']:
+                result['error'] = "git log export failed"
+                return result
+        result['filter_status'] = filter_test_commits(log_file, c4t_dir, stats, test_file_classifier)
+        if result['filter_status'] == "failed":
+            result['error'] = "test commit filtering failed"
+        else:
+            test_log_file_path = test_log_path(c4t_dir, result['repo'], output_format)
+            mark_test_log_filtered(git_log_export_dir, result['repo'], log_file,
+                                   test_log_file_path if result['filter_status'] == "saved" else None)
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        result['seconds'] = time.time() - task_start
+        # Rows and commits parsed from git, and test rows found; a worker's own peak memory
+        stats.pop('_last_commit', None)
+        result.update(stats)
+        result['peak_rss_mb'] = peak_memory_mb()[0]
+    return result
+
+
+# Logs exported by earlier runs for repos outside this run are still filtered, as before
+def leftover_git_logs(final_repos_to_process, git_log_export_dir, completed_repos, output_format='csv'):
+    in_this_run = {git_log_path(git_log_export_dir, repo_name, output_format) for repo_name in final_repos_to_process}
+    leftover_logs = []
+    for log_file in sorted(glob.glob(os.path.join(git_log_export_dir, f"*.{output_format}"))):
+        # Ensure we are not processing the merged file itself if it's in the same directory
+        if os.path.basename(log_file).startswith("all_test_commit_log.") or log_file in in_this_run:
+            continue
+        if log_project_name(log_file) in completed_repos:
+            continue
+        leftover_logs.append(log_file)
+    return leftover_logs
+
+
+# completed_repos maps repos whose export and filtering are already done for their current HEAD
+# to their filter status; they are reported as skipped instead of being processed again.
+def analyze_git_logs(final_repos_to_process, org_projects_dir, git_log_export_dir, c4t_dir, log_workers=1, log_file_path=None,
+                     single_pass=False, keep_full_log=False, incremental=False, completed_repos=None, language='Java',
+                     output_format='csv'):
+    completed_repos = completed_repos or {}
+    tasks = []
+    skipped_results = []
+    for repo_name in final_repos_to_process: # Use the filtered list
+        if repo_name in completed_repos:
+            skipped_results.append({'repo': repo_name, 'exported': True, 'filter_status': completed_repos[repo_name],
+                                    'error': None, 'skipped': True})
+            continue
+        tasks.append((repo_name, git_log_path(git_log_export_dir, repo_name, output_format)))
+    tasks.extend((None, log_file) for log_file in leftover_git_logs(final_repos_to_process, git_log_export_dir,
+                                                                    completed_repos, output_format))
+    if skipped_results:
+        logging.info(f"Git log export and filtering already complete for {len(skipped_results)} repos at their current HEAD. Skipping them.")
+
+    results = list(skipped_results)
+    progress = ProgressTracker("Git log export", len(tasks))
+    if log_workers > 1 and len(tasks) > 1:
+        logging.info(f"Exporting and filtering git logs with {log_workers} worker processes.")
+        with ProcessPoolExecutor(max_workers=log_workers, initializer=init_worker_logging,
+                                 initargs=(log_file_path,)) as executor:
+            futures = {
+                executor.submit(process_repo_git_log, repo_name, log_file, org_projects_dir,
+                                git_log_export_dir, c4t_dir, single_pass, keep_full_log, incremental, language,
+                                output_format): (repo_name, log_file)
+                for repo_name, log_file in tasks
+            }
+            for future in as_completed(futures):
+                repo_name, log_file = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # The worker itself died (e.g. killed by the OOM killer)
+                    project_name = repo_name or log_project_name(log_file)
+                    logging.error(f"Worker processing the git log of {project_name} failed. Reason: {e}")
+                    results.append({'repo': project_name, 'exported': None, 'filter_status': None, 'error': str(e)})
+                progress.advance(results[-1]['repo'])
+        # Keep the reporting order independent of completion order
+        task_order = {repo_name: index for index, repo_name in enumerate(final_repos_to_process)}
+        for repo_name, log_file in tasks:
+            if repo_name is None:
+                task_order[log_project_name(log_file)] = len(task_order)
+        results.sort(key=lambda result: task_order.get(result['repo'], len(task_order)))
+    else:
+        for repo_name, log_file in tasks:
+            results.append(process_repo_git_log(repo_name, log_file, org_projects_dir, git_log_export_dir, c4t_dir,
+                                                single_pass, keep_full_log, incremental, language, output_format))
+            progress.advance(results[-1]['repo'])
+    return results
+
+
+# Record the outcome of a git log export task in the state store and the run metrics
+def record_export_result(state_store, metrics, git_log_export_dir, result):
+    record_repo_metrics(metrics, 'export', result['repo'], **{key: value for key, value in result.items() if key != 'repo'})
+    if result.get('skipped'):
+        record_repo_state(state_store, result['repo'], stage='filtered')
+    elif result['filter_status'] in ("saved", "no_test_commits"):
+        export_state = load_export_state(git_log_export_dir, result['repo']) or {}
+        record_repo_state(state_store, result['repo'], stage='filtered', exported_sha=export_state.get('last_commit'),
+                          test_commit_status=result['filter_status'], export_seconds=result['seconds'], error=None)
+    elif result['exported']:
+        record_repo_state(state_store, result['repo'], stage='exported', export_seconds=result['seconds'],
+                          error=result['error'])
+    else:
+        record_repo_state(state_store, result['repo'], error=result['error'])
+
+# --pipeline: instead of running discovery, cloning and the git log export one after another for
+# all repositories, every repository moves on to its next step as soon as its previous step is
+# done. Discovery runs in the main thread and feeds the pre-check (api_workers threads), which
+# feeds cloning and the build check (clone_workers threads), which feeds the git log export and
+# filtering (log_workers processes). Each stage reads from a queue holding at most
+# PIPELINE_QUEUE_SIZE items per worker, so a slow stage holds back the stages before it instead
+# of letting work pile up. The merge still runs once all logs are filtered.
+PIPELINE_QUEUE_SIZE = 2
+
+
+class PipelineStage:
+    def __init__(self, name, workers, handle, cancel_event, next_stage=None):
+        self.name = name
+        self.workers = max(1, workers)
+        # handle(item) returns the item to pass on to next_stage, or None
+        self.handle = handle
+        self.next_stage = next_stage
+        self.cancel_event = cancel_event
+        self.inbox = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE * self.workers)
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f"{name}-{index}") for index in range(self.workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def put(self, item):
+        self.inbox.put(item)
+
+    # No more items will be put; the workers stop once the queue is empty
+    def close(self):
+        for _ in self._threads:
+            self.inbox.put(None)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                return
+            # After a failure elsewhere, queued items are dropped so the pipeline can wind down
+            if self.cancel_event.is_set():
+                continue
+            item_start = time.time()
+            try:
+                next_item = self.handle(item)
+                if next_item is not None and self.next_stage is not None:
+                    self.next_stage.put(next_item)
+            except Exception as e:
+                logging.error(f"Pipeline stage {self.name} failed for {item}. Reason: {e}")
+            with self._lock:
+                self.items += 1
+                self.busy_seconds += time.time() - item_start
+
+
+# Run discovery, the optional pre-check, cloning and (with git_log_export_dir) the git log export
+# and filtering as a pipeline. Returns the kept repositories, the failed or skipped ones and the
+# export results in the same order and form as the stage-by-stage run, and per-stage statistics.
+# Export results are recorded in the state store and the metrics as soon as they arrive.
+# completed_repos only keeps the leftover logs of finished repos from being filtered again;
+# whether a kept repo is finished is looked up once it is cloned or fetched.
+# Raises GitHubAPIError when discovery fails, after the work already in flight has finished.
+def run_pipeline(client, search_query, pushed_after, org_projects_dir, download_folder_base, perform_build_check,
+                 api_workers=4, clone_workers=1, log_workers=1, precheck_build_system=False, clone_mode='full',
+                 state_store=None, metrics=None, git_log_export_dir=None, c4t_dir=None, log_file_path=None,
+                 single_pass=False, keep_full_log=False, incremental=False, completed_repos=None, language='Java',
+                 output_format='csv', mirror_cache_dir=None, disk_budget=None):
+    completed_repos = completed_repos or {}
+    exporting = git_log_export_dir is not None
+    # Set once the disk usage limit is reached (queued clones are skipped), or when discovery fails
+    stop_event = threading.Event()
+    cancel_event = threading.Event()
+    discovered = {}
+    clone_outcomes = {}
+    precheck_verdicts = {}
+    log_results = []
+    results_lock = threading.Lock()
+    clone_progress = ProgressTracker("Cloning", 0)
+    export_progress = ProgressTracker("Git log export", 0)
+
+    def precheck(repo_detail):
+        verdict = remote_build_verdict(client, repo_detail, state_store)
+        with results_lock:
+            precheck_verdicts[repo_detail['name']] = verdict
+        if verdict is False:
+            record_repo_state(state_store, repo_detail['name'], stage='rejected')
+            return None
+        clone_progress.add()
+        return repo_detail
+
+    def clone(repo_detail):
+        repo_name = repo_detail['name']
+        outcome = clone_and_check_repo(repo_detail, org_projects_dir, download_folder_base, perform_build_check,
+                                       stop_event, incremental, clone_mode, state_store, metrics, mirror_cache_dir,
+                                       disk_budget, exporting)
+        with results_lock:
+            clone_outcomes[repo_name] = outcome
+        clone_progress.advance(repo_name)
+        repo_path_in_org_dir = os.path.join(org_projects_dir, repo_name)
+        # Rejected clones are removed right away to free the disk for the clones still to come
+        if outcome in ("rejected", "failed") and os.path.exists(repo_path_in_org_dir):
+            remove_rejected_clones([repo_path_in_org_dir])
+        if outcome != "kept" or not exporting:
+            return None
+        # Decided only now: with --incremental the clone may just have been fetched to a new HEAD
+        filter_status = completed_exports(state_store, c4t_dir, output_format, repo_name).get(repo_name)
+        if filter_status is not None:
+            skip_result = {'repo': repo_name, 'exported': True, 'filter_status': filter_status,
+                           'error': None, 'skipped': True}
+            record_export_result(state_store, metrics, git_log_export_dir, skip_result)
+            with results_lock:
+                log_results.append(skip_result)
+            return None
+        export_progress.add()
+        return repo_name, git_log_path(git_log_export_dir, repo_name, output_format)
+
+    def export(task):
+        repo_name, log_file = task
+        arguments = (repo_name, log_file, org_projects_dir, git_log_export_dir, c4t_dir, single_pass, keep_full_log,
+                     incremental, language, output_format)
+        try:
+            result = log_executor.submit(process_repo_git_log, *arguments).result()
         except Exception as e:
-            logging.warning(f"Failed to clone or process {repo_name}. Reason: {e}")
-            failed_clones.append(repo_name)
-            # If cloning failed, the path might not exist or be partial.
-            # Ensure we don't try to delete a non-existent/problematic path.
-            if os.path.exists(repo_path_in_org_dir) and repo_path_in_org_dir not in repos_to_delete_after_check:
-                 repos_to_delete_after_check.append(repo_path_in_org_dir)
+            # The worker itself died (e.g. killed by the OOM killer)
+            project_name = repo_name or log_project_name(log_file)
+            logging.error(f"Worker processing the git log of {project_name} failed. Reason: {e}")
+            result = {'repo': project_name, 'exported': None, 'filter_status': None, 'error': str(e)}
+        record_export_result(state_store, metrics, git_log_export_dir, result)
+        with results_lock:
+            log_results.append(result)
+        export_progress.advance(result['repo'])
+
+    with contextlib.ExitStack() as stack:
+        log_executor = None
+        if exporting:
+            # Even a single log worker runs in its own process, so parsing git logs does not compete
+            # with the clone and API threads for the GIL
+            logging.info(f"Exporting and filtering git logs with {log_workers} worker process(es).")
+            log_executor = stack.enter_context(ProcessPoolExecutor(max_workers=max(1, log_workers),
+                                                                   initializer=init_worker_logging,
+                                                                   initargs=(log_file_path,)))
+            # Start the worker processes before any other thread runs: forking a process while
+            # other threads hold locks can deadlock the child
+            for future in [log_executor.submit(os.getpid) for _ in range(max(1, log_workers))]:
+                future.result()
+        export_stage = PipelineStage("export", log_workers, export, cancel_event) if exporting else None
+        clone_stage = PipelineStage("clone", clone_workers, clone, cancel_event, export_stage)
+        precheck_stage = None
+        if precheck_build_system and perform_build_check:
+            precheck_stage = PipelineStage("precheck", api_workers, precheck, cancel_event, clone_stage)
+        stages = [stage for stage in (precheck_stage, clone_stage, export_stage) if stage is not None]
+        for stage in stages:
+            stage.start()
+
+        discovery_start = time.time()
+        try:
+            for repo_detail in iter_discovered_repositories(client, search_query, pushed_after, api_workers):
+                discovered[repo_detail['name']] = repo_detail
+                if state_store is not None:
+                    state_store.mark_discovered([repo_detail])
+                if precheck_stage is not None:
+                    precheck_stage.put(repo_detail)
+                else:
+                    clone_progress.add()
+                    clone_stage.put(repo_detail)
+        except BaseException:
+            cancel_event.set()
+            raise
+        finally:
+            discovery_seconds = time.time() - discovery_start
+            # Each stage is closed once all stages before it have finished, so every item reaches the end
+            for stage in stages:
+                if stage is export_stage and not cancel_event.is_set():
+                    kept_repos = [repo_name for repo_name, outcome in clone_outcomes.items() if outcome == "kept"]
+                    # Only repos that are exported in this run: like the stage-by-stage run
+                    if kept_repos:
+                        for log_file in leftover_git_logs(kept_repos, git_log_export_dir, completed_repos, output_format):
+                            export_progress.add()
+                            stage.put((None, log_file))
+                stage.close()
+                stage.join()
+        logging.info(f"Retrieved {len(discovered)} repositories from API while cloning "
+                     f"({client.stats['requests']} API requests, {client.stats['not_modified']} unchanged pages served from cache).")
+
+    # Report in API order ("recently updated first"), as the stage-by-stage run does
+    repo_order = sorted(discovered.values(), key=lambda repo_detail: repo_detail.get('updated_at') or '', reverse=True)
+    final_repos_to_process = [repo_detail['name'] for repo_detail in repo_order
+                              if clone_outcomes.get(repo_detail['name']) == "kept"]
+    failed_clones = [repo_detail['name'] for repo_detail in repo_order if clone_outcomes.get(repo_detail['name']) == "failed"]
+    skipped_for_disk_space = [repo_detail['name'] for repo_detail in repo_order
+                              if clone_outcomes.get(repo_detail['name']) == "skipped"]
+    if skipped_for_disk_space:
+        failed_clones.extend(skipped_for_disk_space)
+        logging.info(f"The following repos were not attempted due to disk space: {skipped_for_disk_space}")
+    if precheck_stage is not None:
+        rejected_repos = [repo_name for repo_name, verdict in precheck_verdicts.items() if verdict is False]
+        undecided = sum(1 for verdict in precheck_verdicts.values() if verdict is None)
+        logging.info(f"Build system pre-check: {len(precheck_verdicts) - len(rejected_repos) - undecided} qualifying, "
+                     f"{len(rejected_repos)} rejected without cloning, {undecided} undecided (checked after cloning).")
+
+    task_order = {repo_name: index for index, repo_name in enumerate(final_repos_to_process)}
+    log_results.sort(key=lambda result: (task_order.get(result['repo'], len(task_order)), result['repo']))
+    stage_stats = {'discover_seconds': round(discovery_seconds, 3), 'repos': len(discovered)}
+    for stage in stages:
+        stage_stats[f"{stage.name}_items"] = stage.items
+        stage_stats[f"{stage.name}_busy_seconds"] = round(stage.busy_seconds, 3)
+    return final_repos_to_process, failed_clones, log_results, stage_stats
+
+# Merge the per-project test commit logs into one CSV with an extra 'Project' column.
+# Each file is streamed row by row straight into the merged file, so the work is linear in the
+# total number of rows and only one project's set of author emails is held in memory at a time.
+# Returns the number of merged rows and the number of unique authors per project (or None for
+# the author statistics if the 'Author Email' column is missing).
+# Parquet logs are merged into a Parquet file when all_test_commits_csv ends in .parquet.
+@profiled
+def merge_test_commit_logs(test_log_files, all_test_commits_csv):
+    if all_test_commits_csv.endswith(".parquet"):
+        return merge_test_commit_logs_parquet(test_log_files, all_test_commits_csv)
+    merged_rows = 0
+    author_stats = {}
+    missing_author_column = False
+    partial_merged_path = all_test_commits_csv + ".partial"
+
+    with open(partial_merged_path, mode='w', newline='', encoding='utf-8') as merged_file:
+        writer = None
+        for log_file in test_log_files:
+            project_name = log_project_name(log_file)
+            # Remember where this project starts so a file that fails halfway can be rolled back
+            merged_file.flush()
+            project_start = merged_file.tell()
+            project_rows = 0
+            project_authors = set()
+            try:
+                with open(log_file, newline='', encoding='utf-8') as file:
+                    reader = csv.DictReader(file)
+                    if not reader.fieldnames:
+                        logging.warning(f"Test commit log file {log_file} is empty. Skipping from merge.")
+                        continue
+                    if writer is None:
+                        # The first file decides the column layout, like the first frame passed to pd.concat
+                        writer = csv.DictWriter(merged_file, fieldnames=list(reader.fieldnames) + ['Project'],
+                                                extrasaction='ignore', lineterminator='\n')
+                        writer.writeheader()
+                    has_author_column = 'Author Email' in reader.fieldnames
+                    for row in reader:
+                        row['Project'] = project_name
+                        writer.writerow(row)
+                        project_rows += 1
+                        # Empty emails are NaN for pandas and were never counted by nunique()
+                        if has_author_column and row['Author Email']:
+                            project_authors.add(row['Author Email'])
+                if not has_author_column:
+                    missing_author_column = True
+                merged_rows += project_rows
+                if project_rows:
+                    author_stats[project_name] = len(project_authors)
+            except Exception as e:
+                logging.error(f"Error merging file {log_file}. Reason: {e}")
+                merged_file.seek(project_start)
+                merged_file.truncate()
+
+    if merged_rows:
+        os.replace(partial_merged_path, all_test_commits_csv)
+    else:
+        os.remove(partial_merged_path)
+    return merged_rows, (None if missing_author_column else author_stats)
 
 
-    # Delete repos that were cloned but failed build system check
-    if repos_to_delete_after_check:
-        logging.info(f"Cleaning up {len(repos_to_delete_after_check)} repos that failed build system check...")
-        for repo_path_to_delete in repos_to_delete_after_check:
+# merge_test_commit_logs for Parquet logs. Each project's table is read whole, given its
+# 'Project' column and only then written, so a file that fails to load leaves nothing behind.
+def merge_test_commit_logs_parquet(test_log_files, all_test_commits_path):
+    merged_rows = 0
+    author_stats = {}
+    missing_author_column = False
+    partial_merged_path = all_test_commits_path + ".partial"
+    merged_schema = None
+    writer = None
+
+    try:
+        for log_file in test_log_files:
+            project_name = log_project_name(log_file)
             try:
-                shutil.rmtree(repo_path_to_delete)
-                logging.info(f"Successfully deleted {repo_path_to_delete}")
+                table = pq.read_table(log_file)
+                if merged_schema is None:
+                    # The first file decides the column layout, like in the CSV merge
+                    merged_schema = table.schema.append(pa.field('Project', pa.dictionary(pa.int32(), pa.string())))
+                project_column = pa.DictionaryArray.from_arrays(pa.array([0] * table.num_rows, pa.int32()),
+                                                                pa.array([project_name], pa.string()))
+                table = (table.select([name for name in merged_schema.names if name != 'Project'])
+                         .append_column('Project', project_column).cast(merged_schema))
+                project_authors = None
+                if 'Author Email' in table.column_names:
+                    # Empty emails are not counted, as in the CSV merge
+                    project_authors = set(pc.unique(table['Author Email'].cast(pa.string())).to_pylist()) - {None, ''}
             except Exception as e:
-                logging.error(f"Failed to delete directory {repo_path_to_delete}. Reason: {e}")
+                logging.error(f"Error merging file {log_file}. Reason: {e}")
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(partial_merged_path, merged_schema, compression=PARQUET_COMPRESSION)
+            writer.write_table(table)
+            if project_authors is None:
+                missing_author_column = True
+            merged_rows += table.num_rows
+            if table.num_rows:
+                author_stats[project_name] = len(project_authors or ())
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if merged_rows:
+        os.replace(partial_merged_path, all_test_commits_path)
+    elif os.path.exists(partial_merged_path):
+        os.remove(partial_merged_path)
+    return merged_rows, (None if missing_author_column else author_stats)
+
+
+# Create the git log and c4t directories, remove the merged log of an earlier run and log the
+# export settings. Returns the directories, the merged log path and the repos whose logs are
+# already complete for their current HEAD.
+def prepare_git_log_export(org_projects_dir, state_store, language, output_format='csv', single_pass=False,
+                           keep_full_log=False, incremental=False):
+    # Path adjustments: log_dir is now relative to org_projects_dir
+    git_log_export_dir = os.path.join(org_projects_dir, "git_log")
+    if not os.path.exists(git_log_export_dir):
+        logging.info(f"Creating git log export directory {git_log_export_dir}")
+        os.makedirs(git_log_export_dir)
+
+    # Path adjustments: c4t_dir is relative to git_log_export_dir
+    c4t_dir = os.path.join(git_log_export_dir, "c4t") # c4t: commit for test
+
+    if not os.path.exists(c4t_dir):
+        logging.info(f"Creating c4t directory {c4t_dir}")
+        os.makedirs(c4t_dir)
+
+    all_test_commits_csv = merged_test_log_path(c4t_dir, output_format)
+    if os.path.exists(all_test_commits_csv):
+        logging.info(f"Deleting old merged test commit log: {all_test_commits_csv}")
+        os.remove(all_test_commits_csv)
+
+    if incremental:
+        logging.info("Incremental export is ENABLED; only commits since the last export are appended.")
+    if single_pass:
+        logging.info(f"Single-pass export is ENABLED; full git logs are {'kept' if keep_full_log else 'not written'}.")
+    if output_format != 'csv':
+        logging.info(f"Commit logs are written as {output_format} files.")
+    test_file_language = TestFileClassifier(language).language
+    if test_file_language != TEST_FILE_RULE_ALIASES.get(language.lower(), language.lower()):
+        logging.warning(f"No test file rules for language {language}. Using the {test_file_language} rules.")
+    logging.info(f"Test files are identified with the {test_file_language} rules: {TEST_FILE_RULES[test_file_language]}")
+    completed_repos = completed_exports(state_store, c4t_dir, output_format)
+    return git_log_export_dir, c4t_dir, all_test_commits_csv, completed_repos
+
+
+# Repos whose logs are complete for their current HEAD are not exported or filtered again.
+# Pass repo_name to only look at that repo, e.g. right after it was cloned or fetched.
+def completed_exports(state_store, c4t_dir, output_format='csv', repo_name=None):
+    if state_store is None:
+        return {}
+    return {
+        name: filter_status for name, filter_status in state_store.finished_exports(repo_name).items()
+        if filter_status == "no_test_commits" or os.path.exists(test_log_path(c4t_dir, name, output_format))
+    }
+
+
+# Main script execution
+def main(org_name, min_stars, download_folder_base, export_git_log, language, disable_build_system_check, clone_workers=1,
+         log_workers=1, single_pass=False, keep_full_log=False,
+         incremental=False, api_url=GITHUB_API_URL, api_cache_dir=None,
+         api_workers=4, clone_mode='full', ignore_state=False, profile=False, output_format='csv',
+         precheck_build_system=False, pipeline=False, mirror_cache=None, disk_budget=None, clone_priority='stars'):
+    # Create the base download dir if it doesn't exist
+    if not os.path.exists(download_folder_base):
+        os.makedirs(download_folder_base)
+
+    # Create the specific dir for the organization within the download folder
+    org_projects_dir = os.path.join(download_folder_base, org_name + "-projects")
+    if not os.path.exists(org_projects_dir):
+        os.makedirs(org_projects_dir)
+
+    # Set log level and file path
+    log_file_path = os.path.join(org_projects_dir, 'repodigger.log')
+    configure_logging(log_file_path)
+
+    if output_format == 'parquet' and pq is None:
+        logging.error("--output-format parquet needs pyarrow. Install it with: pip install \"repodigger[parquet]\"")
+        return
+
+    logging.info(f"Starting repodigger for organization: {org_name}")
+    logging.info(f"Minimum stars: {min_stars}")
+    logging.info(f"Language filter: {language}")
+    logging.info(f"Download folder: {org_projects_dir}")
+
+    # Per-repo progress of this and earlier runs, used to skip finished work and resume
+    state_store = PipelineStateStore(os.path.join(org_projects_dir, STATE_STORE_FILE), reuse=not ignore_state)
+    if ignore_state:
+        logging.info("Ignoring the state of earlier runs (--ignore-state); all work is redone.")
+    metrics = RunMetrics(os.path.join(org_projects_dir, METRICS_FILE))
+    if profile:
+        profile_dir = os.path.join(org_projects_dir, "profiles")
+        enable_profiling(profile_dir)
+        logging.info(f"Profiling is ENABLED; cProfile statistics are written to {profile_dir}")
+    if mirror_cache:
+        mirror_cache = os.path.abspath(mirror_cache)
+        logging.info(f"Cloning through the shared mirrors in {mirror_cache}; --clone-mode does not apply to these clones.")
+    # Space for new clones is reserved against the budget instead of polling the disk usage
+    budget = DiskBudget(download_folder_base, disk_budget) if disk_budget is not None else None
+
+    # Determine if build system check should be performed
+    perform_build_check = False
+    if language.lower() == 'java':
+        if not disable_build_system_check:
+            perform_build_check = True
+            logging.info("Build system check is ENABLED for Java projects.")
+        else:
+            logging.info("Build system check is EXPLICITLY DISABLED via --disable-build-system-check flag for Java projects.")
+    else:
+        logging.warning(f"Build system check is AUTOMATICALLY DISABLED for non-Java language: {language}. All cloned repositories for this language will be kept regardless of their build system (if any).")
+
+    # Get the project list from the GitHub API
+    logging.info("=== Getting the project list from the GitHub API ===")
+    # Calculate three years ago for the pushed date query
+    three_years_ago = (datetime.now() - timedelta(days=3*365)).strftime('%Y-%m-%d') # Approximate 3 years
+    # pushed:>DATE means pushed on any later day, so the searched range starts the day after
+    pushed_after = datetime.strptime(three_years_ago, '%Y-%m-%d') + timedelta(days=1)
+    # Query for stars>=min_stars and the language parameter; the pushed date range (last 3 years)
+    # is added per search shard
+    search_query = f"org:{org_name} language:{language} archived:false stars:>={min_stars}"
+
+    # API responses are revalidated with ETag/Last-Modified on later runs, so unchanged pages cost no quota
+    if api_cache_dir is None:
+        api_cache_dir = os.path.join(org_projects_dir, "api_cache")
+    client = GitHubClient(GITHUB_TOKEN, api_url=api_url, cache_dir=api_cache_dir, pool_size=max(10, api_workers))
+    if pipeline:
+        logging.info("=== Discovering, cloning and exporting repositories as a pipeline ===")
+        git_log_export_dir = c4t_dir = None
+        completed_repos = {}
+        if export_git_log:
+            git_log_export_dir, c4t_dir, all_test_commits_csv, completed_repos = prepare_git_log_export(
+                org_projects_dir, state_store, language, output_format, single_pass, keep_full_log, incremental)
+    try:
+        if pipeline:
+            with metrics.stage('pipeline') as stage_metrics:
+                try:
+                    final_repos_to_process, failed_clones, log_results, pipeline_stats = run_pipeline(
+                        client, search_query, pushed_after, org_projects_dir, download_folder_base, perform_build_check,
+                        api_workers, clone_workers, log_workers, precheck_build_system, clone_mode, state_store, metrics,
+                        git_log_export_dir, c4t_dir, log_file_path, single_pass, keep_full_log, incremental,
+                        completed_repos, language, output_format, mirror_cache, budget)
+                    stage_metrics.update(pipeline_stats, kept=len(final_repos_to_process), failed=len(failed_clones),
+                                         bytes=sum(record.get('bytes', 0) for record in metrics.records
+                                                   if record['type'] == 'repo' and record['stage'] == 'clone'))
+                    for counter in ('rows', 'commits', 'test_rows'):
+                        stage_metrics[counter] = sum(result.get(counter, 0) for result in log_results)
+                    if budget is not None:
+                        stage_metrics['over_budget'] = len(budget.over_budget)
+                finally:
+                    stage_metrics.update(client.stats)
+        else:
+            with metrics.stage('discover') as stage_metrics:
+                try:
+                    repos_with_details = discover_repositories(client, search_query, pushed_after, api_workers)
+                    stage_metrics['repos'] = len(repos_with_details)
+                finally:
+                    stage_metrics.update(client.stats)
+    except GitHubAPIError as e:
+        # A partial repository list would silently drop projects, so stop instead
+        logging.error(f"Failed to retrieve repositories: {e}")
+        logging.error(f"Repodigger stopped for {org_name} because the repository list is incomplete.")
+        client.close()
+        metrics.write(status='discovery_failed')
+        state_store.close()
+        return
+    if pipeline:
+        client.close()
+    else:
+        logging.info(f"Retrieved {len(repos_with_details)} repositories from API before build system check "
+                     f"({client.stats['requests']} API requests, {client.stats['not_modified']} unchanged pages served from cache).")
+        state_store.mark_discovered(repos_with_details)
+
+        if precheck_build_system and perform_build_check:
+            logging.info("=== Checking build systems before cloning ===")
+            with metrics.stage('precheck') as stage_metrics:
+                requests_before = client.stats['requests']
+                repos_with_details, precheck_rejected = precheck_build_systems(client, repos_with_details, state_store,
+                                                                               api_workers)
+                stage_metrics.update(repos_to_clone=len(repos_with_details), rejected=len(precheck_rejected),
+                                     requests=client.stats['requests'] - requests_before)
+        client.close()
+        if budget is not None:
+            repos_with_details = plan_disk_budget(repos_with_details, org_projects_dir, budget, clone_priority)
+
+        logging.info("=== Cloning repositories and checking build systems ===")
+        if clone_workers > 1:
+            logging.info(f"Cloning with {clone_workers} concurrent workers.")
+        if clone_mode != 'full':
+            logging.info(f"Using {clone_mode} partial clones.")
+            if export_git_log:
+                logging.info("The objects left out by the partial clones are fetched in one go for the repositories that are kept.")
+        with metrics.stage('clone') as stage_metrics:
+            final_repos_to_process, repos_to_delete_after_check, failed_clones = clone_repositories(
+                repos_with_details, org_projects_dir, download_folder_base, perform_build_check, clone_workers, incremental,
+                clone_mode, state_store, metrics, mirror_cache, budget, export_git_log)
+            clone_records = [record for record in metrics.records if record['type'] == 'repo' and record['stage'] == 'clone']
+            stage_metrics.update(kept=len(final_repos_to_process),
+                                 rejected=sum(1 for record in clone_records if record['outcome'] == 'rejected'),
+                                 failed=len(failed_clones), bytes=sum(record.get('bytes', 0) for record in clone_records))
+            if budget is not None:
+                stage_metrics['over_budget'] = len(budget.over_budget)
+
+            # Delete repos that were cloned but failed build system check
+            if repos_to_delete_after_check:
+                logging.info(f"Cleaning up {len(repos_to_delete_after_check)} repos that failed build system check...")
+                remove_rejected_clones(repos_to_delete_after_check)
     
+    if budget is not None:
+        logging.info(f"Disk budget: {format_size(budget.used)} of {format_size(budget.capacity)} used by new clones.")
+        if budget.over_budget:
+            logging.info(f"{len(budget.over_budget)} repos did not fit into the disk budget: {budget.over_budget}")
+            over_budget_projects_file = os.path.join(org_projects_dir, "over_budget_projects.txt")
+            with open(over_budget_projects_file, "w") as file:
+                for repo_name in budget.over_budget:
+                    file.write(f"{repo_name}\n")
+            logging.info(f"List of repos over the disk budget saved to {over_budget_projects_file}")
+
     # Save list of genuinely failed clones (network issues, git errors, disk full partway, etc.)
     if failed_clones:
         logging.info(f"Failed to clone or process {len(failed_clones)} repos: {failed_clones}")
@@ -256,135 +2507,33 @@ def main(org_name, min_stars, download_folder_base, export_git_log, language, di
     if not final_repos_to_process:
         logging.info("No repositories met all criteria to proceed with log export and analysis.")
         logging.info(f"Repodigger finished processing for {org_name}. No projects to analyze further.")
+        metrics.write(status='no_repos')
+        state_store.close()
         return # Exit if no repos to process
 
     # Conditionally execute git log export and analysis
     if export_git_log: 
         logging.info(f"Proceeding with {len(final_repos_to_process)} qualified repositories: {final_repos_to_process}")
-        # Start to export the git log from the cloned repos
-        logging.info("=== Exporting the git log ===")
-        # create the folder to store the git log
-        # Path adjustments: log_dir is now relative to org_projects_dir
-        git_log_export_dir = os.path.join(org_projects_dir, "git_log")
-        if not os.path.exists(git_log_export_dir):
-            logging.info(f"Creating git log export directory {git_log_export_dir}")
-            os.makedirs(git_log_export_dir)
-
-        # Export the git log with the diff information as a CSV file
-        def export_git_log_to_csv(repo_name, cloned_repos_container_dir, target_log_dir):
-            # repo_path is the full path to the specific repo inside org_projects_dir
-            repo_full_path = os.path.join(cloned_repos_container_dir, repo_name)
-            log_file_path = os.path.join(target_log_dir, f"{repo_name}_git_log.csv")
-
-            # Ensure git commands run from within the repo's directory or use -C
-            # Using -C is safer
-            git_command = [
-                'git', '-C', repo_full_path, 'log',
-                '--date=short',
-                '--numstat',
-                '--pretty=format:%H,%ad,%aN,%ae' # Removed "commit " prefix from here
-            ]
-
-            try:
-                # Check if log file already exists
-                if os.path.exists(log_file_path):
-                    logging.info(f"Git log for {repo_name} already exists at {log_file_path}. Skipping export.")
-                    return
-
-                result = subprocess.run(git_command, capture_output=True, text=True, check=True, encoding='utf-8') # Added encoding
-                output = result.stdout
-
-                with open(log_file_path, mode='w', newline='', encoding='utf-8') as file:
-                    writer = csv.writer(file)
-                    writer.writerow(["Commit Hash", "Date", "Author Name", "Author Email", "Added Lines", "Deleted Lines", "File Path"])
-
-                    current_commit_info = [] # Renamed from commit_info
-                    for line in output.splitlines(): # use splitlines()
-                        if not line.strip(): # Skip empty lines that might occur between commit blocks
-                            continue
-                        
-                        # Check if the line is a commit metadata line (Hash,Date,Author,Email)
-                        # This regex is more robust for parsing the commit metadata line.
-                        # It expects 4 comma-separated values.
-                        parts = line.split(',', 3)
-                        if len(parts) == 4 and len(parts[0]) == 40 and all(c in '0123456789abcdef' for c in parts[0]): # Heuristic for commit hash
-                            current_commit_info = parts
-                        elif current_commit_info and '\t' in line:  # Assumed numstat line associated with current_commit_info
-                            stats = line.split('\t')
-                            if len(stats) == 3:  # Added, Deleted, Path
-                                # Handle cases where added/deleted might be '-'
-                                added = stats[0] if stats[0] != '-' else '0'
-                                deleted = stats[1] if stats[1] != '-' else '0'
-                                writer.writerow(current_commit_info + [added, deleted, stats[2]])
-                        # else:
-                            # logging.debug(f"Skipping unparsed line for {repo_name}: {line}")
-
-
-                logging.info(f"Successfully exported git log for {repo_name} to {log_file_path}")
-            except subprocess.CalledProcessError as e:
-                logging.warning(f"Failed to export git log for {repo_name}. Reason: {e.stdout} {e.stderr}")
-            except Exception as ex: # Catch other potential errors like file writing issues
-                logging.warning(f"An unexpected error occurred during git log export for {repo_name}. Reason: {ex}")
-
-
-        for repo_name in final_repos_to_process: # Use the filtered list
-            logging.info(f"Exporting git log for {repo_name}...")
-            export_git_log_to_csv(repo_name, org_projects_dir, git_log_export_dir)
-
-
-        # start to analyze the git log
-        logging.info("=== Analyzing the git log ===")
-        # Path adjustments: c4t_dir is relative to git_log_export_dir
-        c4t_dir = os.path.join(git_log_export_dir, "c4t") # c4t: commit for test
-
-        if not os.path.exists(c4t_dir):
-            logging.info(f"Creating c4t directory {c4t_dir}")
-            os.makedirs(c4t_dir)
-
-        all_test_commits_csv = os.path.join(c4t_dir, "all_test_commit_log.csv")
-        if os.path.exists(all_test_commits_csv):
-            logging.info(f"Deleting old merged test commit log: {all_test_commits_csv}")
-            os.remove(all_test_commits_csv)
-
-        # Use git_log_export_dir to find log files, not log_dir from before
-        log_files = glob.glob(os.path.join(git_log_export_dir, "*.csv"))
-
-
-        no_test_commit_repos = []
-
-        for log_file in log_files:
-            # Ensure we are not processing the merged file itself if it's in the same directory
-            if os.path.basename(log_file) == "all_test_commit_log.csv":
-                continue
-            try:
-                df = pd.read_csv(log_file)
-                
-                # Ensure 'File Path' column exists
-                if 'File Path' not in df.columns:
-                    project_name_from_file = os.path.basename(log_file).replace('_git_log.csv', '')
-                    logging.warning(f"Skipping {project_name_from_file}: 'File Path' column missing in {log_file}.")
-                    continue
-
-                # Filter records: .java files with 'Test' in name and 'src/test/' in file path
-                # Make sure File Path is string type before using .str.contains
-                df['File Path'] = df['File Path'].astype(str)
-                filtered_df = df[df['File Path'].str.contains(r'src/test/.*Test.*\.java', regex=True, na=False)]
-
-
-                project_name = os.path.basename(log_file).replace('_git_log.csv', '')
-                if not filtered_df.empty:
-                    filtered_df.to_csv(os.path.join(c4t_dir, f"{project_name}_test_commit_log.csv"), index=False)
-                    logging.info(f"Saved test commit log for {project_name}")
-                else:
-                    logging.warning(f"No test-related commits found for {project_name}")
-                    no_test_commit_repos.append(project_name)
-            except pd.errors.EmptyDataError:
-                project_name_from_file = os.path.basename(log_file).replace('_git_log.csv', '')
-                logging.warning(f"Log file {log_file} for project {project_name_from_file} is empty or not valid CSV. Skipping.")
-            except Exception as e:
-                project_name_from_file = os.path.basename(log_file).replace('_git_log.csv', '')
-                logging.error(f"Error processing log file {log_file} for {project_name_from_file}. Reason: {e}")
+        # In a pipelined run the logs are already exported and filtered
+        if not pipeline:
+            # Export and analyze the git log of every repo; each repo is independent of the others
+            logging.info("=== Exporting and analyzing the git log ===")
+            git_log_export_dir, c4t_dir, all_test_commits_csv, completed_repos = prepare_git_log_export(
+                org_projects_dir, state_store, language, output_format, single_pass, keep_full_log, incremental)
+            with metrics.stage('export') as stage_metrics:
+                log_results = analyze_git_logs(final_repos_to_process, org_projects_dir, git_log_export_dir, c4t_dir,
+                                               log_workers, log_file_path, single_pass, keep_full_log, incremental,
+                                               completed_repos, language, output_format)
+                for counter in ('rows', 'commits', 'test_rows'):
+                    stage_metrics[counter] = sum(result.get(counter, 0) for result in log_results)
+                stage_metrics['repos'] = len(log_results)
+            for result in log_results:
+                record_export_result(state_store, metrics, git_log_export_dir, result)
 
+        no_test_commit_repos = [result['repo'] for result in log_results if result['filter_status'] == "no_test_commits"]
+        failed_log_repos = [result['repo'] for result in log_results if result['error']]
+        if failed_log_repos:
+            logging.warning(f"Git log export or analysis failed for {len(failed_log_repos)} repos: {failed_log_repos}")
 
         if no_test_commit_repos:
             logging.info(f"No test-related commits found for {len(no_test_commit_repos)} repos: {no_test_commit_repos}")
@@ -396,48 +2545,39 @@ def main(org_name, min_stars, download_folder_base, export_git_log, language, di
 
 
         logging.info("=== Merging the test commit log ===")
-        # merge all the test commit log files into one dataframe
+        # merge all the test commit log files into one file
         # Use c4t_dir to find individual test log csv files
-        test_log_files = glob.glob(os.path.join(c4t_dir, "*_test_commit_log.csv"))
-        # Exclude the all_test_commit_log.csv itself if somehow it matches the pattern above, though unlikely with suffix
-        test_log_files = [f for f in test_log_files if os.path.basename(f) != "all_test_commit_log.csv"]
+        test_log_files = glob.glob(os.path.join(c4t_dir, f"*_test_commit_log.{output_format}"))
+        # Exclude the all_test_commit_log file itself if somehow it matches the pattern above, though unlikely with suffix
+        test_log_files = [f for f in test_log_files if f != all_test_commits_csv]
 
 
         if not test_log_files:
             logging.info("No individual test commit logs found to merge.")
         else:
-            merged_df = pd.DataFrame()
-            for log_file in test_log_files:
-                try:
-                    df = pd.read_csv(log_file)
-                    project_name = os.path.basename(log_file).replace('_test_commit_log.csv', '')
-                    df['Project'] = project_name
-                    merged_df = pd.concat([merged_df, df], ignore_index=True)
-                except pd.errors.EmptyDataError:
-                    logging.warning(f"Test commit log file {log_file} is empty. Skipping from merge.")
-                except Exception as e:
-                    logging.error(f"Error merging file {log_file}. Reason: {e}")
+            with metrics.stage('merge') as stage_metrics:
+                merged_rows, author_stats = merge_test_commit_logs(sorted(test_log_files), all_test_commits_csv)
+                stage_metrics.update(files=len(test_log_files), rows=merged_rows)
 
-
-            if not merged_df.empty:
-                merged_df.to_csv(all_test_commits_csv, index=False)
-                logging.info(f"Saved merged test commit log to {all_test_commits_csv}")
+            if merged_rows:
+                logging.info(f"Saved merged test commit log ({merged_rows} rows) to {all_test_commits_csv}")
 
                 # Log the statistics of the test commit
                 logging.info("=== Test commit statistics ===")
                 # Ensure 'Author Email' column exists before grouping
-                if 'Author Email' in merged_df.columns:
-                    author_stats = merged_df.groupby('Project')['Author Email'].nunique()
+                if author_stats is not None:
                     logging.info("Number of unique authors per project (with test commits):")
-                    for project, count in author_stats.items():
+                    for project, count in sorted(author_stats.items()):
                         logging.info(f"{project}: {count}")
                 else:
                     logging.warning("Could not generate author statistics: 'Author Email' column not found in merged data.")
             else:
-                logging.info("Merged DataFrame is empty. No overall test commit log generated.")
+                logging.info("Merged test commit log is empty. No overall test commit log generated.")
     else: # This else corresponds to if export_git_log is False
         logging.info("Git log export and analysis skipped as per --export-git-log flag.")
 
+    metrics.write(status='finished')
+    state_store.close()
     logging.info(f"Repodigger finished processing for {org_name}.")
 
 
@@ -449,10 +2589,33 @@ def main_cli():
     parser.add_argument("--export-git-log", action='store_true', help="Optional: Export git log for each repository and analyze test commits. Disabled by default.")
     parser.add_argument("--language", type=str, default='Java', help="Programming language to filter repositories by (e.g., Java, Python). Defaults to Java.")
     parser.add_argument("--disable-build-system-check", action='store_true', help="Disable the build system check (Maven/Gradle vs Ant/Bazel). By default, this check is active for Java projects.")
-    
+    parser.add_argument("--api-url", type=str, default=GITHUB_API_URL, help="Base URL of the GitHub REST API (e.g., for GitHub Enterprise or a local stub). Defaults to $GITHUB_API_URL or https://api.github.com.")
+    parser.add_argument("--api-cache-dir", type=str, default=None, help="Directory for cached GitHub API responses. Defaults to <download-folder>/<org>-projects/api_cache.")
+    parser.add_argument("--api-workers", type=int, default=4, help="Number of GitHub search pages fetched concurrently. Defaults to 4.")
+    parser.add_argument("--clone-workers", type=int, default=1, help="Number of repositories to clone and check concurrently. Defaults to 1 (sequential).")
+    parser.add_argument("--pipeline", action='store_true', help="Clone and export each repository as soon as it is discovered and cloned, instead of finishing each step for all repositories first.")
+    parser.add_argument("--precheck-build-system", action='store_true', help="Check the build system from the file tree listed by the GitHub API before cloning, so rejected repositories are never cloned.")
+    parser.add_argument("--clone-mode", choices=sorted(CLONE_MODE_OPTIONS), default='full', help="How to clone repositories: 'full' (default), 'blobless' (--filter=blob:none) or 'treeless' (--filter=tree:0). Partial clones are only checked out after passing the build system check; with --export-git-log, kept partial clones then fetch all their missing objects at once.")
+    parser.add_argument("--mirror-cache", type=str, default=None, help="Directory of bare repository mirrors shared by all runs. Clones are made from the mirrors, which only fetch new objects, and borrow their objects instead of copying them.")
+    parser.add_argument("--disk-budget", type=parse_size, default=None, help="Disk space that new clones may take up, e.g. 200G. Space is reserved from the sizes reported by the API before each clone, and repositories that do not fit are skipped, instead of stopping at 90%% disk usage.")
+    parser.add_argument("--clone-priority", choices=CLONE_PRIORITIES, default='stars', help="With --disk-budget, which repositories are cloned first: the most starred ('stars', default) or the most recently pushed ('recency').")
+    parser.add_argument("--ignore-state", action='store_true', help="Redo all work instead of skipping what earlier runs recorded as finished in <org>-projects/repodigger_state.sqlite.")
+    parser.add_argument("--profile", action='store_true', help="Profile the hot functions with cProfile and write the statistics to <org>-projects/profiles.")
+    parser.add_argument("--log-workers", type=int, default=1, help="Number of worker processes for git log export and test commit filtering. Defaults to 1 (sequential).")
+    parser.add_argument("--single-pass", action='store_true', help="Classify test commits while exporting the git log and write the c4t logs directly, instead of writing the full log and re-reading it.")
+    parser.add_argument("--keep-full-log", action='store_true', help="With --single-pass, also write the full <repo>_git_log.csv files.")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default='csv', help="File format of the git logs and test commit logs: 'csv' (default) or 'parquet' (compressed and columnar; needs pyarrow).")
+    parser.add_argument("--incremental", action='store_true', help="Fetch new commits into existing clones and append only the commits since the last export to the git logs.")
+
     args = parser.parse_args()
     
-    main(args.organization, args.min_stars, args.download_folder, args.export_git_log, args.language, args.disable_build_system_check)
+    main(args.organization, args.min_stars, args.download_folder, args.export_git_log, args.language, args.disable_build_system_check,
+         clone_workers=args.clone_workers, log_workers=args.log_workers,
+         single_pass=args.single_pass, keep_full_log=args.keep_full_log, incremental=args.incremental,
+         api_url=args.api_url, api_cache_dir=args.api_cache_dir, api_workers=args.api_workers,
+         clone_mode=args.clone_mode, ignore_state=args.ignore_state, profile=args.profile,
+         output_format=args.output_format, precheck_build_system=args.precheck_build_system, pipeline=args.pipeline,
+         mirror_cache=args.mirror_cache, disk_budget=args.disk_budget, clone_priority=args.clone_priority)
 
 if __name__ == "__main__":
     main_cli()